@@ -1,121 +1,336 @@
 '''
 Given a BED file and a corresponding set of all genes, this module helps
 map each BED entry to its most proximal gene. The bulk of such logic is made
-possible using the BEDtools package.
+possible using an in-process interval index of the annotations.
 '''
 
 import argparse
 import numpy as np
-import sys
-import os
-from pandas import DataFrame
-from bisect import bisect_left as bleft
-from src.ioutils import parse_config, exec_closest_app, exec_average_app
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from tempfile import NamedTemporaryFile
+from pandas import DataFrame, read_table
+from src.ioutils import (FORMATS, parse_arguments, parse_config,
+                         exec_average_app, open_writer, write_results)
+from src.intervals import (IntervalIndex, NO_HIT, annotation_name,
+                           closest_all)
 from src.model import BEDFileFactory
+from src.cache import open_cache
+from src.incremental import (annotation_fingerprint, element_fingerprint,
+                             group_key, open_store)
+from src import external, metrics
 
 
-def get_gtf_positions(l):
+def map_features(b, annot, index=None):
     '''
-    List-representation of a strong produced from a GTF file.
-    @param l: List object
-    @return: tuple containing start and end indices of the provided list.
+    Find the most proximal GTF entry given a BEDFile object. All BED entries
+    are queried at once against an interval index of the annotations,
+    resulting in a distance (base-pair; integer) separating each entry and
+    its respective GTF entry. Overlapping annotations are ignored.
+    @param b: BEDFile object.
+    @param annot: BED/GTF filename
+    @param index: IntervalIndex of annot; built from annot if not provided.
     '''
 
-    return l[3], l[4]
+    map_all_features(b, [annot], None if index is None else [index])
 
 
-def get_bed_positions(l):
+def map_all_features(b, annots, indexes=None):
     '''
-    List-representation of a strong produced from a BED file.
-    @param l: List object
-    @return: tuple containing start and end indices of the provided list.
+    Find the most proximal entry of many BED/GTF files given a BEDFile
+    object. BED entries are grouped by chromosome only once, and each group
+    is queried against every annotation; see map_features.
+    @param b: BEDFile object.
+    @param annots: list of BED/GTF filenames.
+    @param indexes: list of IntervalIndex objects, ordered as per annots;
+    built from annots if not provided.
     '''
 
-    return l[1], l[2]
+    if indexes is None:
+        indexes = [IntervalIndex.from_file(annot) for annot in annots]
+    with metrics.stage('closest', file=b.get_file(), annot=annots,
+                       rows=b.get_data().shape[0]):
+        hits = closest_all(indexes, b.get_data())
+    assign_features(b, annots, hits)
 
 
-def map_features(b, annot):
+def assign_features(b, annots, hits):
     '''
-    Find the most proximal GTF entry given a BEDFile object. Each BED entry
-    is iteratively queried to find the most proximal GTF entry, resulting in
-    a distance (base-pair; integer) separating this entry and its respective
-    GTF entry. This GTF file, however, must have a 'gene_id' attribute so that
-    the most proximal GTF entry can explicitly be identified.
+    Adds the hit start, hit end, distance, and distance interval of every
+    annotation to each entry of a BEDFile object.
     @param b: BEDFile object.
-    @param annot: BED/GTF filename
-    @return: list referencing most proximal GTF entry for each BED entry.
-    '''
-
-    hit_start, hit_end, ds = [], [], []
-    n_cols = len(open(b.get_file()).readline().split('\t'))  # columns of BED
-    out = exec_closest_app(b.get_file(), annot)
-    for l in out.splitlines():
-        l = l.decode('utf-8').split('\t')
-        if annot.endswith('bed'):
-            start, end = get_bed_positions(l[n_cols:])
-        elif annot.endswith('gtf'):
-            start, end = get_gtf_positions(l[n_cols:])
-        hit_start.append(start)  # append the start and end bases
-        hit_end.append(end)
-        ds.append(int(l[-1]))  # add most proximal distance
-    b.get_data()['Hit_Start-' + os.path.basename(annot)] = hit_start
-    b.get_data()['Hit_End-' + os.path.basename(annot)] = hit_end
-    b.get_data()['Distance-' + os.path.basename(annot)] = ds
-    b.get_data()['Intv-' + os.path.basename(annot)] =\
-                [bleft(range(0, int(2e5), int(1e4)), p) for p in ds]
-
-
-def map_signals(b, annot):
+    @param annots: list of BED/GTF filenames.
+    @param hits: list of tuples; hit start, hit end, and distance arrays,
+    ordered as per annots.
+    '''
+
+    names = [annotation_name(annot) for annot in annots]
+    if len(set(names)) != len(names):
+        raise IOError('Annotation files must have unique filenames.')
+    for name, (hit_start, hit_end, ds) in zip(names, hits):
+        b.get_data()['Hit_Start-' + name] = hit_start
+        b.get_data()['Hit_End-' + name] = hit_end
+        b.get_data()['Distance-' + name] = ds
+        b.get_data()['Intv-' + name] =\
+                    np.searchsorted(range(0, int(2e5), int(1e4)), ds, 'left')
+
+
+def map_signals(b, annot, jobs=None):
     '''
     Maps BigWig files onto the user-provided BED file. In many cases, multiple
-    BigWig files are provided; each is iteratively mapped to each BED entry
-    and the mean bigwig value is derived.
+    BigWig files are provided; all proximal features are written to a single
+    region set which is averaged once per BigWig file, with BigWig files
+    processed concurrently. The mean across BigWig files is then derived.
     @param b: BEDFile object
+    @param annot: BED/GTF filename
+    @param jobs: number of BigWig files to average concurrently.
+    '''
+
+    with metrics.stage('signals', file=b.get_file(),
+                       rows=b.get_data().shape[0]):
+        _map_signals(b, annot, jobs)
+
+
+def _map_signals(b, annot, jobs):
+    data = b.get_data()
+    name = annotation_name(annot)
+    regions = DataFrame({'Chr': data['Chr'].values,
+                         'Start': data['Hit_Start-' + name].values,
+                         'End': data['Hit_End-' + name].values,
+                         'Name': np.arange(data.shape[0])})
+    regions = regions[regions['Start'] != NO_HIT]  # entries with a feature
+    with NamedTemporaryFile('w', suffix='.bed') as bed:
+        regions.to_csv(bed, sep='\t', header=False, index=False)
+        bed.flush()
+        with ThreadPoolExecutor(jobs) as pool:  # one average per BigWig
+            outs = list(pool.map(lambda bw: exec_average_app(bed.name, bw),
+                                 b.get_bigwigs()))
+    reps = np.full((len(outs), data.shape[0]), np.nan)  # bigwig x entry
+    for num, out in enumerate(outs):  # join averages by entry row-number
+        if not out.strip():
+            continue  # no entry has a proximal feature
+        avg = read_table(BytesIO(out), header=None, sep='\t')
+        reps[num, avg[0].values] = avg[avg.columns[-1]].values
+    data['Signal'] = reps.mean(axis=0)  # append the mean
+
+
+def map_bed(b, args, indexes):
+    '''
+    Maps features, and signals if need-be, onto a BEDFile object.
+    @param b: BEDFile object.
+    @param args: dictionary of command-line arguments.
+    @param indexes: list of IntervalIndex objects, ordered as per -annot.
+    @return: data-frame of annotated BED contents.
+    '''
+
+    map_all_features(b, args['annot'], indexes)
+    if args['signals']:  # map signals (BigWig files), if need-be
+        map_signals(b, args['annot'][0], args['jobs'])
+    return b.get_data()
+
+
+def incremental_beds(elems, args, store):
+    '''
+    Maps features, and signals if need-be, onto BEDFile objects whose BED
+    files or annotations changed; all others are re-used from the store.
+    @param elems: list of XML elements, i.e. from parse_config.
+    @param args: dictionary of command-line arguments.
+    @param store: ResultStore object; annotated BED contents are persisted.
+    @return: list of annotated BEDFile objects, ordered as per elems.
     '''
 
-    signal = []
-    for _, row in b.get_data().iterrows():  # row-number, row, respectively
-        reps = []  # store bigwig replicate-averages across bigwig files
-        for bw in b.get_bigwigs():  # compute BED average given bigwig
-            out = exec_average_app(row['Chr'],
-                                   row['Hit_Start-' + os.path.basename(annot)],
-                                   row['Hit_End-' + os.path.basename(annot)],
-                                   bw)
-            reps.append(float(out.decode('utf-8').strip().split('\t')[-1]))
-        signal.append(np.mean(reps))  # append the mean
-    b.get_data()['Signal'] = signal
+    annots = [(annotation_name(annot), annotation_fingerprint(annot))
+              for annot in args['annot']]
+    keys = [group_key('closest', element_fingerprint(elem), annots,
+                      args['features'], args['signals']) for elem in elems]
+    stale = [num for num, key in enumerate(keys) if not store.contains([key])]
+    cache, indexes = open_cache(args['cache']), []
+    built = dict(zip(stale, BEDFileFactory.build_all(
+        [elems[i] for i in stale], args['jobs'], cache)))  # changed BEDs
+    beds = []
+    for num, key in enumerate(keys):
+        b = BEDFileFactory(elems[num]).describe()
+        b.set_data(store.recall([key], lambda: [annotate_element(
+            elems[num], built.pop(num, None), args, indexes, cache)],
+            b.get_file())[0])
+        beds.append(b)
+    return beds
+
+
+def annotate_element(elem, b, args, indexes, cache=None):
+    '''
+    Maps features, and signals if need-be, onto the BEDFile object of an XML
+    element whose results are absent from the store. Results deemed present
+    may since have been evicted, hence such elements are built here.
+    @param elem: XML element.
+    @param b: BEDFile object of elem; built from elem if None.
+    @param args: dictionary of command-line arguments.
+    @param indexes: list of IntervalIndex objects, ordered as per -annot;
+    built in-place if empty so that unchanged annotations are never indexed.
+    @param cache: ParseCache object; parsed BED contents are re-used.
+    @return: data-frame of annotated BED contents.
+    '''
+
+    if not indexes:
+        indexes.extend(IntervalIndex.from_file(annot, args['features'])
+                       for annot in args['annot'])
+    if b is None:  # evicted since deemed fresh
+        b = BEDFileFactory(elem).build(cache)
+    return map_bed(b, args, indexes)
 
 
 def main(args):
     '''
     Given a list of BEDFile objects, compute the distance of each BEDFile
-    object-entry to its most proximal feature as defined by -annot. If any
-    BEDFile object references a set of BigWig files, subsequently map the
-    proximal features start and end onto these bigwig files. Doing so
+    object-entry to its most proximal feature as defined by each -annot. If
+    any BEDFile object references a set of BigWig files, subsequently map the
+    proximal features start and end, given the first -annot, onto these
+    bigwig files. Doing so
     facilitates derivation of a mean value that helps infer a signal for the
     proximal annotation entry.
     @param args: dictionary of command-line arguments.
     '''
 
-    beds = [BEDFileFactory(elm).build() for elm in parse_config(args['in'])]
-    df = DataFrame()
-    for b in beds:  # otherwise, work with all other BED files.
-        map_features(b, args['annot'])
+    metrics.configure(args['metrics'], args['profile'])
+    folder = None
+    if args['external']:  # sort BED and annotations on-disk
+        folder = tempfile.mkdtemp(dir=args['tmp'], prefix='bedframework-')
+    try:
+        annotate(args, folder)
+    finally:
+        if folder is not None:
+            shutil.rmtree(folder, ignore_errors=True)
+
+
+def annotate(args, folder=None):
+    '''
+    Maps features, and signals if need-be, onto each BEDFile object and
+    sends the results to standard-output; see main.
+    @param args: dictionary of command-line arguments.
+    @param folder: folder for out-of-core sorting; in-memory if None.
+    '''
+
+    elems = parse_config(args['in'])
+    store = open_store(args['incremental'])
+    if store is not None and (args['chunk'] or folder is not None):
+        raise IOError('-incremental cannot be used with -chunk, --external.')
+    if store is not None:  # only changed BED files are annotated
+        write_results(BEDFileFactory.combine(incremental_beds(elems, args,
+                                                              store)),
+                      args['out'], args['format'])
+        return
+    if folder is None and not args['chunk']:  # all BEDs are held in memory
+        run(args, BEDFileFactory.build_all(elems, args['jobs'],
+                                           open_cache(args['cache'])))
+        return
+    if folder is not None:  # out-of-core; bounded by -memory
+        beds = external_beds(elems, args, folder)
+    else:  # only one chunk is held in memory
+        indexes = [IntervalIndex.from_file(annot, args['features'])
+                   for annot in args['annot']]  # index annotations once
+        beds = BEDFileFactory.stream_all(elems, args['chunk'])
+    header = None
+    with open_writer(args['out'], args['format']) as writer:
+        for b in beds:  # each chunk is written once annotated
+            if folder is None:  # external chunks are already annotated
+                map_bed(b, args, indexes)
+            if header is not None and header != list(b.get_data().columns):
+                raise IOError('Streamed BED files must share the same '
+                              'columns.')
+            writer.write(b.get_data())
+            header = list(b.get_data().columns)
+
+
+def external_beds(elems, args, folder):
+    '''
+    Maps features, and signals if need-be, onto chunks of BED lines whereby
+    BED files and annotations are sorted out-of-core; see external.
+    @param elems: list of XML elements, i.e. from parse_config.
+    @param args: dictionary of command-line arguments.
+    @param folder: folder for out-of-core sorting.
+    @return: generator of annotated BEDFile objects, in file order.
+    '''
+
+    indexes = [external.index_annotation(annot, folder, args['memory'],
+                                         'annot' + str(num),
+                                         args['features'])
+               for num, annot in enumerate(args['annot'])]
+    for b, hits in external.stream_closest(elems, indexes, folder,
+                                           args['memory']):
+        found = [tuple(hits[:, num, i] for i in range(3))
+                 for num in range(len(indexes))]  # as per closest_all
+        assign_features(b, args['annot'], found)
         if args['signals']:  # map signals (BigWig files), if need-be
-            map_signals(b, args['annot'])
-        df = df.append(b.get_data(), ignore_index=True)
-    df.to_csv(sys.stdout, index=False)
+            map_signals(b, args['annot'][0], args['jobs'])
+        yield b
+
+
+def run(args, beds, df=None, indexes=None):
+    '''
+    Maps features, and signals if need-be, onto BEDFile objects held in
+    memory and sends the results to standard-output; see main.
+    @param args: dictionary of command-line arguments.
+    @param beds: list of BEDFile objects; already built.
+    @param df: unused; present as per all other scripts.
+    @param indexes: list of IntervalIndex objects, ordered as per -annot;
+    built from -annot if not provided.
+    '''
+
+    if indexes is None:  # index annotations once
+        indexes = [IntervalIndex.from_file(annot, args['features'])
+                   for annot in args['annot']]
+    for b in beds:
+        map_bed(b, args, indexes)
+    write_results(BEDFileFactory.combine(beds), args['out'], args['format'])
+
+
+def arguments(parser):
+    '''
+    Adds the command-line arguments of this script.
+    @param parser: argparse.ArgumentParser object.
+    @return: the same parser.
+    '''
+
+    parser.add_argument('-in', metavar='XML', required=True,
+                        help='XML configuration file [req]')
+    parser.add_argument('-cache', metavar='DIR', default=None,
+                        help='Cache parsed BED files in folder [None]')
+    parser.add_argument('-annot', metavar='FILE', required=True,
+                        nargs='+', help='BED/GTF annotations files, '
+                        'or their saved indexes (.idx) [req]')
+    parser.add_argument('-features', metavar='TYPE', default=None,
+                        nargs='+', help='GTF feature types, i.e. gene '
+                        '[all]')
+    parser.add_argument('--signals', action='store_true', default=False,
+                        help='Map BED bigwigs signals to features [false]')
+    parser.add_argument('-jobs', metavar='INT', default=None, type=int,
+                        help='Workers for loading BEDs, BigWigs [#CPUs]')
+    parser.add_argument('-chunk', metavar='INT', default=None, type=int,
+                        help='Stream BEDs; INT lines per chunk [None]')
+    parser.add_argument('--external', action='store_true', default=False,
+                        help='Sort BEDs, annotations on-disk [false]')
+    parser.add_argument('-memory', metavar='MB', default=1024, type=int,
+                        help='Memory ceiling given --external [1024]')
+    parser.add_argument('-tmp', metavar='DIR', default=None,
+                        help='Folder for sorting given --external [TMP]')
+    parser.add_argument('-incremental', metavar='DIR', default=None,
+                        help='Re-use per-BED results in folder [None]')
+    parser.add_argument('-out', metavar='FILE', default=None,
+                        help='Results filename [stdout]')
+    parser.add_argument('-format', default='csv', choices=FORMATS,
+                        help='Results format; all but csv need -out [csv]')
+    parser.add_argument('-metrics', metavar='FILE', default=None,
+                        help='Append per-stage metrics to FILE [None]')
+    parser.add_argument('-profile', metavar='DIR', default=None,
+                        help='Save per-stage cProfile dumps to DIR [None]')
+    return parser
+
 
 if __name__ == '__main__':
     try:
-        parser = argparse.ArgumentParser()
-        parser.add_argument('-in', metavar='XML', required=True,
-                            help='XML configuration file [req]')
-        parser.add_argument('-annot', metavar='FILE', required=True,
-                            help='BED/GTF annotations file [req]')
-        parser.add_argument('--signals', action='store_true', default=False,
-                            help='Map BED bigwigs signals to features [false]')
-        args = vars(parser.parse_args())
+        args = parse_arguments(arguments(argparse.ArgumentParser()))
         main(args)
     except KeyboardInterrupt:
         print()
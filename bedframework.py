@@ -0,0 +1,258 @@
+'''
+Unifies each analysis script as a subcommand of a single command-line tool.
+Subcommands are imported only once selected; lengths, for instance, never
+imports SciPy. Analyses may also be sent to a daemon listening on a Unix
+socket; such a daemon parses its configuration once, keeping BEDFile objects
+and their combined contents resident across requests.
+'''
+
+import argparse
+import copy
+import importlib
+import json
+import os
+import shutil
+import socket
+import stat
+import sys
+from contextlib import redirect_stderr, redirect_stdout
+
+COMMANDS = {'lengths': 'lengths', 'error': 'vector_error',
+            'similarity': 'vector_similarity',
+            'proximity': 'annotated_proximity', 'random': 'random_proximity',
+            'query': 'region_query', 'index': 'src.intervals'}
+RESIDENT = ['cache', 'chunk', 'external', 'incremental']  # not for a daemon
+LOADERS = ['lengths', 'error']  # commands whose -jobs only loads BED files
+LOCAL = ['index']  # always run in-process, even given -socket
+
+
+def command_parser(command):
+    '''
+    @param command: subcommand; a key of COMMANDS.
+    @return: tuple of the subcommand module and its argument parser.
+    '''
+
+    module = importlib.import_module(COMMANDS[command])  # imported lazily
+    parser = argparse.ArgumentParser(prog='bedframework ' + command)
+    return module, module.arguments(parser)
+
+
+def detach(beds):
+    '''
+    @param beds: list of BEDFile objects.
+    @return: list of BEDFile objects whose contents can be amended, i.e. with
+    proximity columns, without amending those of beds.
+    '''
+
+    copies = []
+    for b in beds:
+        c = copy.copy(b)
+        c.set_data(b.get_data().copy(deep=False))
+        copies.append(c)
+    return copies
+
+
+class Daemon():
+    '''
+    Answers analysis requests given BEDFile objects built only once. Each
+    request is a JSON line referencing a subcommand, its arguments, and the
+    working directory of the client; output is streamed back until the
+    connection is closed. Requests are answered one at a time.
+    '''
+    def __init__(self, args):
+        from src.cache import open_cache
+        from src.ioutils import parse_config
+        from src.model import BEDFileFactory
+        self._config = os.path.abspath(args['in'])
+        self._beds = BEDFileFactory.build_all(parse_config(self._config),
+                                              args['jobs'],
+                                              open_cache(args['cache']))
+        self._df = BEDFileFactory.combine(self._beds)
+        self._indexes = {}  # (annotations, features) => metadata, index
+
+    def indexes(self, args):
+        '''
+        @param args: dictionary of proximity command-line arguments.
+        @return: list of IntervalIndex objects, ordered as per -annot; each
+        is rebuilt only if its annotations changed.
+        '''
+        from src.incremental import stat_fingerprint
+        from src.intervals import IntervalIndex
+        indexes = []
+        for annot in args['annot']:
+            key = (os.path.abspath(annot), tuple(args['features'] or []))
+            meta = stat_fingerprint(annot)
+            if key not in self._indexes or self._indexes[key][0] != meta:
+                self._indexes[key] = (meta, IntervalIndex.from_file(
+                    annot, args['features']))
+            indexes.append(self._indexes[key][1])
+        return indexes
+
+    def answer(self, request):
+        '''
+        Performs a single analysis, sending its output to standard-output.
+        @param request: dictionary of command, argv, and cwd.
+        '''
+        if request['command'] not in COMMANDS:
+            raise IOError('Unknown command: ' + str(request['command']))
+        if request['command'] in LOCAL:
+            raise IOError(request['command'] + ' is not served by a daemon.')
+        cwd = os.getcwd()
+        os.chdir(request['cwd'])  # paths are relative to the client
+        try:
+            self._answer(request)
+        finally:
+            os.chdir(cwd)
+
+    def _answer(self, request):
+        from src.ioutils import parse_arguments
+        module, parser = command_parser(request['command'])
+        try:
+            args = parse_arguments(parser, request['argv'])
+        except SystemExit:  # usage, or -h, was already sent
+            return
+        if os.path.abspath(args['in']) != self._config:
+            raise IOError('Daemon only serves ' + self._config)
+        if any(args.get(i) for i in RESIDENT):
+            raise IOError('-cache, -chunk, --external, -incremental do not '
+                          'apply as BED files are resident.')
+        if request['command'] in LOADERS and args.get('jobs') is not None:
+            raise IOError('-jobs does not apply to ' + request['command'] +
+                          ' as BED files are resident.')
+        from src import metrics
+        with metrics.configured(args.get('metrics'), args.get('profile')):
+            if request['command'] == 'proximity':
+                module.run(args, detach(self._beds),
+                           indexes=self.indexes(args))
+            else:
+                module.run(args, detach(self._beds), self._df)
+
+    def handle(self, conn):
+        '''
+        Answers a single connection. Failed requests are reported to the
+        client, unless it has disconnected, whereby they are reported to
+        standard-error of the daemon instead; the daemon lives on either way.
+        @param conn: socket of the client.
+        @return: whether a stop request was received.
+        '''
+        stream = conn.makefile('rw')
+        try:
+            try:
+                request = json.loads(stream.readline())
+                if request['command'] == 'stop':
+                    return True
+                with redirect_stdout(stream), redirect_stderr(stream):
+                    self.answer(request)
+            except (BrokenPipeError, ConnectionResetError):
+                raise
+            except Exception as e:  # malformed request, or failed analysis
+                print(e, file=stream)
+            stream.flush()
+        except (BrokenPipeError, ConnectionResetError) as e:
+            print('Client disconnected: ' + str(e), file=sys.stderr)
+        finally:
+            try:
+                stream.close()
+            except OSError:
+                pass  # client disconnected; unsent output is discarded
+            conn.close()
+        return False
+
+    def serve(self, path):
+        '''
+        Listens on a Unix socket until a stop request is received.
+        @param path: socket filename; a stale socket is replaced.
+        '''
+        path = os.path.abspath(path)  # requests change the working folder
+        if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+            os.remove(path)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(path)
+        server.listen()
+        try:
+            while not self.handle(server.accept()[0]):
+                pass
+        finally:
+            server.close()
+            os.remove(path)
+
+
+def send(path, command, argv):
+    '''
+    Sends an analysis request to a daemon; its output is relayed to
+    standard-output.
+    @param path: socket filename.
+    @param command: subcommand, or stop.
+    @param argv: list of subcommand arguments.
+    '''
+
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.connect(path)
+    with client, client.makefile('rwb') as stream:
+        stream.write(json.dumps({'command': command, 'argv': argv,
+                                 'cwd': os.getcwd()}).encode('utf-8') + b'\n')
+        stream.flush()
+        shutil.copyfileobj(stream, sys.stdout.buffer)
+
+
+def serve_arguments(parser):
+    '''
+    Adds the command-line arguments of the serve subcommand.
+    @param parser: argparse.ArgumentParser object.
+    @return: the same parser.
+    '''
+
+    parser.add_argument('-in', metavar='XML', required=True,
+                        help='XML configuration file [req]')
+    parser.add_argument('-cache', metavar='DIR', default=None,
+                        help='Cache parsed BED files in folder [None]')
+    parser.add_argument('-jobs', metavar='INT', default=None, type=int,
+                        help='Worker processes for loading BEDs [#CPUs]')
+    parser.add_argument('-metrics', metavar='FILE', default=None,
+                        help='Append per-stage metrics to FILE [None]')
+    parser.add_argument('-profile', metavar='DIR', default=None,
+                        help='Save per-stage cProfile dumps to DIR [None]')
+    return parser
+
+
+def main(args):
+    '''
+    Runs a subcommand in-process, sends it to a daemon given -socket, or
+    starts and stops a daemon.
+    @param args: dictionary of command-line arguments.
+    '''
+
+    if args['command'] == 'stop' and not args['socket']:
+        raise IOError('stop requires -socket.')
+    if args['command'] == 'serve':
+        if not args['socket']:
+            raise IOError('serve requires -socket.')
+        parser = argparse.ArgumentParser(prog='bedframework serve')
+        serve_args = vars(serve_arguments(parser).parse_args(args['argv']))
+        from src import metrics
+        metrics.configure(serve_args['metrics'], serve_args['profile'])
+        Daemon(serve_args).serve(args['socket'])
+    elif args['socket'] and args['command'] not in LOCAL:
+        send(args['socket'], args['command'], args['argv'])
+    else:
+        from src.ioutils import parse_arguments
+        module, parser = command_parser(args['command'])
+        module.main(parse_arguments(parser, args['argv']))
+
+
+if __name__ == '__main__':
+    try:
+        parser = argparse.ArgumentParser(prog='bedframework')
+        parser.add_argument('-socket', metavar='FILE', default=None,
+                            help='Daemon socket to serve, or send to [None]')
+        parser.add_argument('command', choices=list(COMMANDS) +
+                            ['serve', 'stop'], help='Analysis, or daemon '
+                            'control')
+        parser.add_argument('argv', nargs=argparse.REMAINDER,
+                            help='Arguments of the analysis; see COMMAND -h')
+        args = vars(parser.parse_args())  # parse arguments
+        main(args)
+    except KeyboardInterrupt:
+        print()
+    except IOError as e:
+        print(e)
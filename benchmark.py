@@ -0,0 +1,131 @@
+'''
+Benchmarks each analytical stage given synthetic, yet deterministic, inputs.
+Each stage is timed and its peak memory recorded; results are sent to
+standard-output as JSON lines so that runs can be contrasted across releases.
+'''
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from src import synthetic
+from src.config import TISSUE_SPEC, UBIQUITOUS
+from src.intervals import IntervalIndex
+from src.ioutils import parse_config
+from src.model import BEDFileFactory
+from annotated_proximity import map_features, map_signals
+from vector_error import interval_table
+from vector_similarity import similarity_table
+
+
+def measure(stage, rows, func, *args):
+    '''
+    Times a function and records its peak memory. Tracing slows allocation
+    down, hence func is timed untraced and then run once more, traced, only
+    to record its peak memory; func must therefore be repeatable.
+    @param stage: name of the stage.
+    @param rows: number of rows the stage processes.
+    @param func: function to benchmark.
+    @param args: arguments passed to func.
+    @return: tuple of the function output and a dictionary of measurements.
+    '''
+
+    start = time.perf_counter()
+    out = func(*args)
+    seconds = time.perf_counter() - start
+    tracemalloc.start()
+    func(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return out, {'stage': stage, 'rows': rows, 'seconds': seconds,
+                 'rows_per_second': rows / seconds if seconds else None,
+                 'peak_bytes': peak}
+
+
+def generate(folder, args):
+    '''
+    Generates synthetic BED, GTF, and configuration files.
+    @param folder: folder to save files.
+    @param args: dictionary of command-line arguments.
+    @return: tuple of configuration and GTF filenames.
+    '''
+
+    beds = []
+    for num in range(args['tissues']):
+        for cls in [TISSUE_SPEC, UBIQUITOUS]:
+            fname = os.path.join(folder, str(num) + '-' + cls + '.bed')
+            seed = args['seed'] + len(beds)
+            synthetic.write_vectorized_bed(fname, args['entries'], seed)
+            beds.append((fname, cls, 'tissue' + str(num)))
+    bigwigs = [args['bigwig']] if args['bigwig'] else []
+    xml = synthetic.write_config(os.path.join(folder, 'config.xml'), beds,
+                                 bigwigs=bigwigs)
+    gtf = synthetic.write_gtf(os.path.join(folder, 'genes.gtf'),
+                              args['genes'], args['seed'])
+    return xml, gtf
+
+
+def main(args):
+    '''
+    Generates synthetic inputs and benchmarks parsing, closest-feature
+    mapping, signal mapping, confidence intervals, and rank-sum tests.
+    @param args: dictionary of command-line arguments.
+    '''
+
+    folder = args['dir'] or tempfile.mkdtemp(prefix='bedframework-')
+    try:
+        xml, gtf = generate(folder, args)
+        rows = args['entries'] * args['tissues'] * 2
+        results = []
+        beds, r = measure('parse', rows, BEDFileFactory.build_all,
+                          parse_config(xml), 1)
+        results.append(r)
+        index, r = measure('index', args['genes'],
+                           IntervalIndex.from_file, gtf)
+        results.append(r)
+        _, r = measure('closest', rows, lambda: [map_features(b, gtf, index)
+                                                 for b in beds])
+        results.append(r)
+        if args['bigwig'] and shutil.which('bigWigAverageOverBed'):
+            _, r = measure('signals', rows, lambda: [map_signals(b, gtf)
+                                                     for b in beds])
+        else:  # BigWig files cannot be generated offline
+            r = {'stage': 'signals', 'skipped': True}
+        results.append(r)
+        df = BEDFileFactory.combine(beds)
+        _, r = measure('ci', rows, interval_table, df)
+        results.append(r)
+        _, r = measure('ranksum', rows, similarity_table, df)
+        results.append(r)
+        for r in results:
+            r.update({'entries': args['entries'], 'tissues': args['tissues'],
+                      'genes': args['genes'], 'seed': args['seed']})
+            print(json.dumps(r), file=sys.stdout)
+    finally:
+        if not args['dir']:
+            shutil.rmtree(folder, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    try:
+        parser = argparse.ArgumentParser()
+        parser.add_argument('-entries', metavar='INT', default=10000,
+                            type=int, help='Entries per BED file [10000]')
+        parser.add_argument('-tissues', metavar='INT', default=2, type=int,
+                            help='Tissues; 2x BED files per tissue [2]')
+        parser.add_argument('-genes', metavar='INT', default=20000, type=int,
+                            help='GTF entries [20000]')
+        parser.add_argument('-seed', metavar='INT', default=0, type=int,
+                            help='Seed for synthetic inputs [0]')
+        parser.add_argument('-bigwig', metavar='FILE', default=None,
+                            help='BigWig file for signal mapping [None]')
+        parser.add_argument('-dir', metavar='DIR', default=None,
+                            help='Keep synthetic inputs in folder [None]')
+        args = vars(parser.parse_args())  # parse arguments
+        main(args)
+    except KeyboardInterrupt:
+        print()
@@ -4,10 +4,102 @@ tissue-class.
 '''
 
 import argparse
-import sys
+import numpy as np
+from pandas import DataFrame, concat
 from src.model import BEDFileFactory
-from src.ioutils import parse_config
-from pandas import concat
+from src.cache import open_cache
+from src import metrics
+from src.ioutils import (FORMATS, parse_arguments, parse_config,
+                         iter_lengths, open_writer, write_results)
+
+REPORTS = ['entries', 'summary', 'histogram']
+SUMMARY = ['Tissue', 'Class', 'Count', 'Mean', 'Min', 'Q1', 'Median', 'Q3',
+           'Max']
+HISTOGRAM = ['Tissue', 'Class', 'Bin_Start', 'Bin_End', 'Count']
+CHUNK = 1 << 20  # BED lines read at a time, unless -chunk is provided
+
+
+def length_counts(elems, chunksize=CHUNK):
+    '''
+    Tallies BED entry lengths given every tissue and class in a single pass;
+    only start and end indices are read, chunksize lines at a time.
+    @param elems: list of XML elements, i.e. from parse_config.
+    @param chunksize: number of BED lines read at a time.
+    @return: dictionary; (tissue, class) => numpy array whose ith element is
+    the number of entries i bp long, ordered by first appearance.
+    '''
+
+    counts = {}
+    for elem in elems:
+        bf = BEDFileFactory(elem).describe()
+        key = (bf.get_tissue(), bf.get_class())
+        tally = counts.setdefault(key, np.zeros(0, dtype=np.int64))
+        with metrics.stage('lengths', file=bf.get_file(), rows=0) as record:
+            for le in iter_lengths(bf.get_file(), bf.is_scalar(), chunksize):
+                if len(le) > 0 and le.min() < 0:
+                    raise IOError(bf.get_file() + ' has negative lengths.')
+                found = np.bincount(le)
+                if len(found) > len(tally):  # longest entry thus far
+                    tally = np.pad(tally, (0, len(found) - len(tally)))
+                tally[:len(found)] += found
+                record['rows'] += len(le)
+        counts[key] = tally
+    return counts
+
+
+def count_quantile(tally, q):
+    '''
+    @param tally: numpy array whose ith element is the number of entries i
+    bp long.
+    @param q: quantile; between 0 and 1.
+    @return: quantile of the tallied lengths; interpolated as per
+    numpy.quantile.
+    '''
+
+    cum = np.cumsum(tally)
+    h = (cum[-1] - 1) * q  # position within the sorted lengths
+    lo, hi = np.searchsorted(cum, [np.floor(h), np.ceil(h)], 'right')
+    return lo + (h - np.floor(h)) * (hi - lo)
+
+
+def summary_table(counts):
+    '''
+    @param counts: dictionary; (tissue, class) => tallied lengths.
+    @return: data-frame of the count, mean, and quartiles of lengths given
+    every tissue and class.
+    '''
+
+    rows = []
+    for (t, c), tally in counts.items():
+        found = np.flatnonzero(tally)
+        if len(found) == 0:
+            continue  # no entries
+        n = tally.sum()
+        rows.append([t, c, n, (found * tally[found]).sum() / n, found[0]] +
+                    [count_quantile(tally, q) for q in [0.25, 0.5, 0.75]] +
+                    [found[-1]])
+    return DataFrame(rows, columns=SUMMARY)
+
+
+def histogram_table(counts, width):
+    '''
+    @param counts: dictionary; (tissue, class) => tallied lengths.
+    @param width: width of each bin; bins span [Bin_Start, Bin_End).
+    @return: data-frame of non-empty bins given every tissue and class.
+    '''
+
+    data = []
+    for (t, c), tally in counts.items():
+        bins = np.bincount(np.arange(len(tally)) // width, weights=tally)
+        found = np.flatnonzero(bins)
+        data.append(DataFrame({'Tissue': t, 'Class': c,
+                               'Bin_Start': found * width,
+                               'Bin_End': (found + 1) * width,
+                               'Count': bins[found].astype(np.int64)},
+                              columns=HISTOGRAM))
+    data = [df for df in data if df.shape[0] > 0]
+    return concat(data, ignore_index=True) if data else\
+        DataFrame(columns=HISTOGRAM)
 
 
 def main(args):
@@ -17,17 +109,105 @@ def main(args):
     @param args: dictionary of command-line arguments.
     '''
 
-    df = concat([BEDFileFactory(e).build().get_data()
-                 for e in parse_config(args['in'])])
-    df[['Length', 'Class', 'Tissue']].to_csv(sys.stdout, index=False)
+    metrics.configure(args['metrics'], args['profile'])
+    if args['report'] != 'entries':  # only coordinates are read
+        report(args, length_counts(parse_config(args['in']),
+                                   args['chunk'] or CHUNK))
+        return
+    if args['chunk']:  # stream BED chunks; only one chunk is held in memory
+        beds = BEDFileFactory.stream_all(parse_config(args['in']),
+                                         args['chunk'])
+        with open_writer(args['out'], args['format']) as writer:
+            for b in beds:
+                writer.write(b.get_data()[['Length', 'Class', 'Tissue']])
+        return
+    cache = open_cache(args['cache'])
+    run(args, BEDFileFactory.build_all(parse_config(args['in']),
+                                       args['jobs'], cache))
+
+
+def run(args, beds, df=None):
+    '''
+    Sends the length, tissue, and class of each BED entry to standard-output.
+    @param args: dictionary of command-line arguments.
+    @param beds: list of BEDFile objects; already built.
+    @param df: data-frame of all BED contents; combined from beds if None.
+    '''
+
+    df = BEDFileFactory.combine(beds) if df is None else df
+    if args['report'] != 'entries':  # lengths are tallied from df
+        report(args, {key: np.bincount(grp['Length'].values)
+                      for key, grp in df.groupby(['Tissue', 'Class'],
+                                                 sort=False, observed=True)})
+        return
+    write_results(df[['Length', 'Class', 'Tissue']], args['out'],
+                  args['format'])
+
+
+def report(args, counts):
+    '''
+    Writes a summary or histogram of tallied lengths.
+    @param args: dictionary of command-line arguments.
+    @param counts: dictionary; (tissue, class) => tallied lengths.
+    '''
+
+    if args['report'] == 'summary':
+        write_results(summary_table(counts), args['out'], args['format'])
+    else:
+        write_results(histogram_table(counts, args['bins']), args['out'],
+                      args['format'])
+
+
+def bin_width(value):
+    '''
+    @param value: -bins as given on the command-line.
+    @return: bin width; a positive integer.
+    '''
+
+    try:
+        width = int(value)
+    except ValueError:
+        width = 0
+    if width < 1:
+        raise argparse.ArgumentTypeError('must be a positive integer: ' +
+                                         value)
+    return width
+
+
+def arguments(parser):
+    '''
+    Adds the command-line arguments of this script.
+    @param parser: argparse.ArgumentParser object.
+    @return: the same parser.
+    '''
+
+    parser.add_argument('-in', metavar='XML', required=True,
+                        help='XML configuration file [req]')
+    parser.add_argument('-cache', metavar='DIR', default=None,
+                        help='Cache parsed BED files in folder [None]')
+    parser.add_argument('-jobs', metavar='INT', default=None, type=int,
+                        help='Worker processes for loading BEDs [#CPUs]')
+    parser.add_argument('-chunk', metavar='INT', default=None, type=int,
+                        help='Stream BEDs; INT lines per chunk [None]')
+    parser.add_argument('-report', default='entries', choices=REPORTS,
+                        help='Lengths per entry, or per tissue, class '
+                        '[entries]')
+    parser.add_argument('-bins', metavar='INT', default=10, type=bin_width,
+                        help='Bin width given -report histogram [10]')
+    parser.add_argument('-out', metavar='FILE', default=None,
+                        help='Results filename [stdout]')
+    parser.add_argument('-format', default='csv', choices=FORMATS,
+                        help='Results format; all but csv need -out [csv]')
+    parser.add_argument('-metrics', metavar='FILE', default=None,
+                        help='Append per-stage metrics to FILE [None]')
+    parser.add_argument('-profile', metavar='DIR', default=None,
+                        help='Save per-stage cProfile dumps to DIR [None]')
+    return parser
 
 
 if __name__ == '__main__':
     try:
-        parser = argparse.ArgumentParser()
-        parser.add_argument('-in', metavar='XML', required=True,
-                            help='XML configuration file [req]')
-        args = vars(parser.parse_args())  # parse arguments
+        args = parse_arguments(arguments(argparse.ArgumentParser()))
         main(args)
     except KeyboardInterrupt:
         print()
@@ -2,10 +2,137 @@
 '''
 
 import argparse
-import sys
+import numpy as np
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from pandas import DataFrame
 from src.model import BEDFileFactory
-from src.ioutils import parse_config, build_random_bed
-from annotated_proximity import map_features
+from src.cache import open_cache
+from src import metrics
+from src.intervals import IntervalIndex, NO_HIT
+from src.ioutils import (FORMATS, parse_arguments, parse_config,
+                         write_results, build_random_bed, index_fasta,
+                         random_regions)
+from annotated_proximity import map_all_features
+
+STATISTICS = ['Mean', 'Median']  # of distances given each set of regions
+BATCH_ROWS = 1 << 22  # random regions queried at a time, per process
+
+
+def distance_statistics(ds, n, k):
+    '''
+    @param ds: numpy array of distances given k sets of n regions each,
+    back-to-back.
+    @param n: number of regions per set.
+    @param k: number of sets.
+    @return: k x len(STATISTICS) numpy array; regions lacking a proximal
+    entry are ignored, and sets lacking any are NaN.
+    '''
+
+    stats = np.full((k, len(STATISTICS)), np.nan)
+    for i in range(k):
+        d = ds[i * n:(i + 1) * n]
+        d = d[d != NO_HIT]
+        if len(d) > 0:
+            stats[i] = d.mean(), np.median(d)
+    return stats
+
+
+def permute(index, names, sizes, lengths, seeds):
+    '''
+    Draws sets of random regions and queries all of them against an index
+    in a single batch.
+    @param index: IntervalIndex of ubiquitous BED entries.
+    @param names: numpy array; name of each FASTA sequence.
+    @param sizes: numpy array; length of each FASTA sequence.
+    @param lengths: numpy array; length of each region in a set.
+    @param seeds: list of numpy SeedSequence objects; one per set.
+    @return: len(seeds) x len(STATISTICS) numpy array.
+    '''
+
+    draws = [random_regions(sizes, lengths, np.random.default_rng(seed))
+             for seed in seeds]  # each set is reproducible on its own
+    chrm = np.concatenate([i[0] for i in draws])
+    start = np.concatenate([i[1] for i in draws])
+    df = DataFrame({'Chr': names[chrm], 'Start': start,
+                    'End': start + np.tile(lengths, len(seeds))})
+    return distance_statistics(index.closest(df)[2], len(lengths),
+                               len(seeds))
+
+
+def permute_file(folder, names, sizes, lengths, seeds):
+    '''
+    Worker-process counterpart of permute; the index is memory-mapped from
+    its saved folder rather than pickled.
+    '''
+
+    return permute(IntervalIndex.load(folder), names, sizes, lengths, seeds)
+
+
+def null_distribution(index, fasta, lengths, n, seed=None, jobs=None):
+    '''
+    Derives the statistics of many sets of random regions, partitioned
+    across worker processes.
+    @param index: IntervalIndex of ubiquitous BED entries.
+    @param fasta: FASTA filename; regions are selected from its sequences.
+    @param lengths: numpy array; length of each region in a set.
+    @param n: number of sets, i.e. permutations.
+    @param seed: seed for reproducible sets.
+    @param jobs: number of worker processes; default is #CPUs.
+    @return: n x len(STATISTICS) numpy array.
+    '''
+
+    fai = index_fasta(fasta)
+    names, sizes = fai['Name'].values.astype(str), fai['Length'].values
+    seeds = np.random.SeedSequence(seed).spawn(n)
+    workers = jobs or os.cpu_count() or 1
+    per = max(min(BATCH_ROWS // max(len(lengths), 1), -(-n // workers)), 1)
+    parts = [seeds[i:i + per] for i in range(0, n, per)]
+    if workers == 1 or len(parts) < 2:  # not worth forking
+        return np.vstack([permute(index, names, sizes, lengths, part)
+                          for part in parts])
+    with tempfile.TemporaryDirectory(prefix='bedframework-') as folder:
+        index.save(os.path.join(folder, 'ub.idx'))
+        with ProcessPoolExecutor(workers) as pool:  # order is retained
+            stats = list(pool.map(permute_file,
+                                  [os.path.join(folder, 'ub.idx')] *
+                                  len(parts), [names] * len(parts),
+                                  [sizes] * len(parts),
+                                  [lengths] * len(parts), parts))
+    return np.vstack(stats)
+
+
+def permutation_test(args, bed_ts, bed_ub):
+    '''
+    Contrasts the distance separating each tissue-specific entry and its
+    most proximal ubiquitous entry against that of random regions. Each set
+    of random regions has the lengths of the tissue-specific entries.
+    @param args: dictionary of command-line arguments.
+    @param bed_ts: tissue-specific BEDFile object.
+    @param bed_ub: ubiquitous BEDFile object.
+    @return: data-frame with the observed value, null summary, and
+    one-sided empirical p-value (observed entries are closer) per statistic.
+    '''
+
+    index = IntervalIndex.from_frame(bed_ub.get_data())  # built only once
+    lengths = bed_ts.get_data()['Length'].values.astype(np.int64)
+    observed = distance_statistics(index.closest(bed_ts.get_data())[2],
+                                   len(lengths), 1)[0]
+    with metrics.stage('permutations', file=bed_ts.get_file(),
+                       rows=args['permutations'] * len(lengths)):
+        null = null_distribution(index, args['fasta'], lengths,
+                                 args['permutations'], args['seed'],
+                                 args['jobs'])
+    if args['null']:
+        DataFrame(null, columns=STATISTICS).to_csv(
+            args['null'], index_label='Permutation')
+    lwr, upr = np.nanpercentile(null, [2.5, 97.5], axis=0)
+    return DataFrame({'Statistic': STATISTICS, 'Observed': observed,
+                      'Null_Mean': np.nanmean(null, axis=0),
+                      'Null_Lwr': lwr, 'Null_Upr': upr,
+                      'PValue': (1 + (null <= observed).sum(axis=0)) /
+                      (1 + (~np.isnan(null)).sum(axis=0))})
 
 
 def main(args):
@@ -23,24 +150,73 @@ def main(args):
     @param args: dictionary of command-line arguments.
     '''
 
-    beds = [BEDFileFactory(e).build() for e in parse_config(args['in'])]
+    metrics.configure(args['metrics'], args['profile'])
+    cache = open_cache(args['cache'])
+    run(args, BEDFileFactory.build_all(parse_config(args['in']),
+                                       args['jobs'], cache))
+
+
+def run(args, beds, df=None):
+    '''
+    Maps the tissue-specific and random BED entries onto the ubiquitous BED
+    entries, sending the results to standard-output; see main.
+    @param args: dictionary of command-line arguments.
+    @param beds: list of BEDFile objects; already built.
+    @param df: unused; present as per all other scripts.
+    '''
+
     if len(beds) != 2:
         raise IOError('2x BED files needed; 1x tissue-specific, 1x ubiquitous')
     bed_ts = [b for b in beds if b.get_class() == 'Tissue-Specific'][0]
     bed_ub = [b for b in beds if b.get_class() == 'Ubiquitous'][0]
-    map_features(bed_ub, bed_ts.get_file())  # map TS BEDs onto ubiquitous
-    randbed = build_random_bed(args['fasta'], bed_ts.get_data().shape[0])
-    map_features(bed_ub, randbed)
-    bed_ub.get_data().to_csv(sys.stdout, index=False)
+    if args['permutations']:  # null distribution of many random draws
+        write_results(permutation_test(args, bed_ts, bed_ub), args['out'],
+                      args['format'])
+        return
+    randbed = build_random_bed(args['fasta'], bed_ts.get_data().shape[0],
+                               fname=args['randbed'], seed=args['seed'])
+    map_all_features(bed_ub, [bed_ts.get_file(), randbed])  # TS and random
+    write_results(bed_ub.get_data(), args['out'], args['format'])
+
+
+def arguments(parser):
+    '''
+    Adds the command-line arguments of this script.
+    @param parser: argparse.ArgumentParser object.
+    @return: the same parser.
+    '''
+
+    parser.add_argument('-in', metavar='XML', required=True,
+                        help='XML configuration file [req]')
+    parser.add_argument('-cache', metavar='DIR', default=None,
+                        help='Cache parsed BED files in folder [None]')
+    parser.add_argument('-jobs', metavar='INT', default=None, type=int,
+                        help='Workers for BEDs, permutations [#CPUs]')
+    parser.add_argument('-fasta', metavar='FASTA', required=True,
+                        help='FASTA for creating random BED entries [req]')
+    parser.add_argument('-randbed', metavar='FILE', default='bedfile.bed',
+                        help='Random BED entries filename [bedfile.bed]')
+    parser.add_argument('-seed', metavar='INT', default=None, type=int,
+                        help='Seed for random BED entries [None]')
+    parser.add_argument('-permutations', metavar='INT', default=None,
+                        type=int, help='Contrast against INT random sets '
+                        '[None]')
+    parser.add_argument('-null', metavar='FILE', default=None,
+                        help='Save statistics of each random set [None]')
+    parser.add_argument('-out', metavar='FILE', default=None,
+                        help='Results filename [stdout]')
+    parser.add_argument('-format', default='csv', choices=FORMATS,
+                        help='Results format; all but csv need -out [csv]')
+    parser.add_argument('-metrics', metavar='FILE', default=None,
+                        help='Append per-stage metrics to FILE [None]')
+    parser.add_argument('-profile', metavar='DIR', default=None,
+                        help='Save per-stage cProfile dumps to DIR [None]')
+    return parser
+
 
 if __name__ == '__main__':
     try:
-        parser = argparse.ArgumentParser()
-        parser.add_argument('-in', metavar='XML', required=True,
-                            help='XML configuration file [req]')
-        parser.add_argument('-fasta', metavar='FASTA', required=True,
-                            help='FASTA for creating random BED entries [req]')
-        args = vars(parser.parse_args())  # parse arguments
+        args = parse_arguments(arguments(argparse.ArgumentParser()))
         main(args)
     except KeyboardInterrupt:
         print()
@@ -0,0 +1,107 @@
+'''
+Enables retrieval of BED entries overlapping a region-of-interest, i.e. a
+locus or gene body, given every tissue and class. Each BED file is indexed
+once by chromosome; only overlapping lines are thereafter read and parsed.
+'''
+
+import argparse
+from src.model import BEDFileFactory
+from src import metrics
+from src.ioutils import FORMATS, parse_arguments, parse_config, write_results
+from src.regions import parse_region
+
+COLUMNS = ['Chr', 'Start', 'End', 'Length', 'Vectors', 'Tissue', 'Class']
+
+
+def query_bounds(args):
+    '''
+    @param args: dictionary of command-line arguments.
+    @return: tuple of chromosome, 0-based start, and end of the region,
+    extended by -window on either side.
+    '''
+
+    if args['window'] < 0:
+        raise IOError('-window must be non-negative.')
+    chrom, start, end = parse_region(args['region'])
+    return chrom, max(start - args['window'], 0), end + args['window']
+
+
+def overlapping(df, chrom, start, end):
+    '''
+    @param df: data-frame containing Chr, Start, and End columns.
+    @param chrom: chromosome name.
+    @param start: 0-based start of the region.
+    @param end: end of the region.
+    @return: data-frame of only those entries overlapping the region.
+    '''
+
+    keep = (df['Chr'].astype(str).values == chrom) &\
+        (df['Start'].values < end) & (df['End'].values > start)
+    return df[keep]
+
+
+def main(args):
+    '''
+    Given a list of BEDFile objects, retrieve entries overlapping a region.
+    Such entries, and the respective tissue and class, are sent to
+    standard-output.
+    @param args: dictionary of command-line arguments.
+    '''
+
+    metrics.configure(args['metrics'], args['profile'])
+    chrom, start, end = query_bounds(args)
+    beds = BEDFileFactory.query_all(parse_config(args['in']), chrom, start,
+                                    end)  # only overlapping lines are parsed
+    write_results(entries(BEDFileFactory.combine(beds)), args['out'],
+                  args['format'])
+
+
+def run(args, beds, df=None):
+    '''
+    Sends the entries overlapping a region to standard-output given BED
+    contents that are already resident; no index is consulted.
+    @param args: dictionary of command-line arguments.
+    @param beds: list of BEDFile objects; already built.
+    @param df: data-frame of all BED contents; combined from beds if None.
+    '''
+
+    df = BEDFileFactory.combine(beds) if df is None else df
+    write_results(entries(overlapping(df, *query_bounds(args))), args['out'],
+                  args['format'])
+
+
+def entries(df):
+    return df[[col for col in COLUMNS if col in df.columns]]
+
+
+def arguments(parser):
+    '''
+    Adds the command-line arguments of this script.
+    @param parser: argparse.ArgumentParser object.
+    @return: the same parser.
+    '''
+
+    parser.add_argument('-in', metavar='XML', required=True,
+                        help='XML configuration file [req]')
+    parser.add_argument('-region', metavar='REGION', required=True,
+                        help='chr, or chr:start-end; 1-based, inclusive '
+                        '[req]')
+    parser.add_argument('-window', metavar='INT', default=0, type=int,
+                        help='Extend the region by INT bp either side [0]')
+    parser.add_argument('-out', metavar='FILE', default=None,
+                        help='Results filename [stdout]')
+    parser.add_argument('-format', default='csv', choices=FORMATS,
+                        help='Results format; all but csv need -out [csv]')
+    parser.add_argument('-metrics', metavar='FILE', default=None,
+                        help='Append per-stage metrics to FILE [None]')
+    parser.add_argument('-profile', metavar='DIR', default=None,
+                        help='Save per-stage cProfile dumps to DIR [None]')
+    return parser
+
+
+if __name__ == '__main__':
+    try:
+        args = parse_arguments(arguments(argparse.ArgumentParser()))
+        main(args)
+    except KeyboardInterrupt:
+        print()
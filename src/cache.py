@@ -0,0 +1,235 @@
+'''
+Persists parsed BED contents on-disk so that subsequent runs memory-map such
+contents rather than re-parsing each BED file from text. Entries are keyed on
+the BED path, size, modification time, and content hash; whenever any of
+these change, the BED file is re-parsed and its stale entry eventually ages
+out through least-recently used eviction.
+'''
+
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import numpy as np
+from pandas import Categorical, DataFrame, isna
+
+VERSION = 4  # bump whenever the on-disk layout changes
+MAX_SIZE = 4 * 1024 ** 3  # default cache ceiling, in bytes
+
+
+def fingerprint(f, is_scalar):
+    '''
+    Derives a key uniquely identifying a BED file and how it is parsed.
+    @param f: BED file.
+    @param is_scalar: whether the BED file is scalar.
+    @return: hexadecimal digest.
+    '''
+
+    stat = os.stat(f)
+    digest = hashlib.sha1()
+    digest.update(repr((VERSION, os.path.abspath(f), stat.st_size,
+                        stat.st_mtime_ns, bool(is_scalar))).encode('utf-8'))
+    with open(f, 'rb') as handle:  # hash contents in bounded chunks
+        for chunk in iter(lambda: handle.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def encode_text(values):
+    '''
+    @param values: numpy array of strings; missing values are permitted.
+    @return: tuple of a uint8 buffer of their UTF-8 bytes, offsets, and
+    which are missing; string i is referenced by
+    buffer[offsets[i]:offsets[i + 1]].
+    '''
+
+    missing = isna(values)
+    encoded = [b'' if m else i.encode('utf-8')
+               for i, m in zip(values, missing)]
+    buf = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+    return buf, np.concatenate(([0], np.cumsum([len(i) for i in encoded],
+                                               dtype=np.int64))), missing
+
+
+def decode_text(buf, offsets, missing):
+    '''
+    @param buf: uint8 buffer, i.e. memory-mapped; see encode_text.
+    @param offsets: offsets of each string within buf.
+    @param missing: whether each string is missing, i.e. NaN.
+    @return: numpy array of strings, as objects.
+    '''
+
+    data = buf.tobytes()
+    return np.array([np.nan if m else data[i:j].decode('utf-8') for i, j, m
+                     in zip(offsets[:-1], offsets[1:], missing)],
+                    dtype=object)
+
+
+def open_cache(folder):
+    '''
+    @param folder: cache folder; caching is disabled if not provided.
+    @return: object of type ParseCache, or None.
+    '''
+
+    return ParseCache(folder) if folder else None
+
+
+class ParseCache():
+    '''
+    Folder of parsed BED data-frames. Each entry is a folder of .npy files;
+    numeric columns and the vector buffer are memory-mapped once loaded.
+    Least-recently used entries are evicted once the folder exceeds its
+    maximum size.
+    '''
+    def __init__(self, folder, max_size=MAX_SIZE):
+        os.makedirs(folder, exist_ok=True)
+        self._folder = folder
+        self._max_size = max_size
+
+    def fetch(self, f, is_scalar, parse):
+        '''
+        Retrieve parsed BED contents, parsing and caching them if need-be.
+        @param f: BED file.
+        @param is_scalar: whether the BED file is scalar.
+        @param parse: function parsing the BED file into a data-frame.
+        @return: data-frame of BED contents.
+        '''
+        key = fingerprint(f, is_scalar)
+        df = self.get(key)
+        if df is None:  # cache-miss; parse then persist
+            df = parse(f)
+            self.put(key, df)
+            self.evict()
+        return df
+
+    def get(self, key):
+        entry = os.path.join(self._folder, key)
+        try:
+            with open(os.path.join(entry, 'meta.json')) as handle:
+                meta = json.load(handle)
+        except (IOError, ValueError):
+            return None
+        os.utime(os.path.join(entry, 'meta.json'))  # mark as recently used
+        cols = {}
+        for num, name in enumerate(meta['columns']):
+            if name == 'Vectors':  # views into the memory-mapped buffer
+                buf = np.load(os.path.join(entry, 'vectors.npy'), 'r')
+                offsets = np.load(os.path.join(entry, 'offsets.npy'))
+                cols[name] = [buf[i:j] for i, j in
+                              zip(offsets[:-1], offsets[1:])]
+            elif meta['categories'][num] is not None:  # codes are mapped
+                codes = np.load(os.path.join(entry, str(num) + '.npy'), 'r')
+                cols[name] = Categorical.from_codes(
+                    codes, categories=meta['categories'][num])
+            elif meta['text'][num]:  # decoded from the mapped buffer
+                cols[name] = decode_text(*[
+                    np.load(os.path.join(entry, str(num) + suffix), 'r')
+                    for suffix in ['.npy', '.offsets.npy', '.missing.npy']])
+            elif meta['pickled'][num]:
+                cols[name] = np.load(os.path.join(entry, str(num) + '.npy'),
+                                     allow_pickle=True)
+            else:
+                cols[name] = np.load(os.path.join(entry, str(num) + '.npy'),
+                                     'r')
+        index = np.load(os.path.join(entry, 'index.npy'), allow_pickle=True)
+        return DataFrame(cols, index=index, columns=meta['columns'])
+
+    def put(self, key, df):
+        entry = os.path.join(self._folder, key)
+        tmp = tempfile.mkdtemp(dir=self._folder, prefix='.tmp-')
+        names, pickled, categories, text = [], [], [], []
+        for num, name in enumerate(df.columns):
+            names.append(name if isinstance(name, str) else int(name))
+            if name == 'Vectors':
+                lengths = [len(v) for v in df['Vectors']]
+                buf = np.empty(sum(lengths), dtype=np.float32)
+                if lengths:
+                    np.concatenate(list(df['Vectors']), out=buf)
+                np.save(os.path.join(tmp, 'vectors.npy'), buf)
+                np.save(os.path.join(tmp, 'offsets.npy'),
+                        np.concatenate(([0], np.cumsum(lengths))))
+                pickled.append(False)
+                categories.append(None)
+                text.append(False)
+                continue
+            if df[name].dtype.name == 'category':  # save codes, categories
+                np.save(os.path.join(tmp, str(num) + '.npy'),
+                        df[name].cat.codes.values)
+                pickled.append(False)
+                categories.append(df[name].cat.categories.tolist())
+                text.append(False)
+                continue
+            categories.append(None)
+            values = df[name].values
+            text.append(values.dtype.kind not in 'biuf' and
+                        all(isinstance(i, str) for i, m in
+                            zip(values, isna(values)) if not m))
+            if text[-1]:  # bytes and offsets; never pickled
+                for suffix, arr in zip(['.npy', '.offsets.npy',
+                                        '.missing.npy'], encode_text(values)):
+                    np.save(os.path.join(tmp, str(num) + suffix), arr)
+                pickled.append(False)
+                continue
+            pickled.append(values.dtype.kind not in 'biuf')
+            np.save(os.path.join(tmp, str(num) + '.npy'), values,
+                    allow_pickle=pickled[-1])
+        np.save(os.path.join(tmp, 'index.npy'), df.index.values,
+                allow_pickle=True)
+        with open(os.path.join(tmp, 'meta.json'), 'w') as handle:
+            json.dump({'columns': names, 'pickled': pickled,
+                       'categories': categories, 'text': text}, handle)
+        try:  # atomic; concurrent writers of the same key are harmless
+            os.rename(tmp, entry)
+        except OSError:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    def entries(self):
+        '''
+        @return: list of tuples; last-used time, size, and folder per entry.
+        '''
+        entries = []
+        for key in os.listdir(self._folder):
+            entry = os.path.join(self._folder, key)
+            meta = os.path.join(entry, 'meta.json')
+            if key.startswith('.') or not os.path.exists(meta):
+                continue
+            size = sum(os.path.getsize(os.path.join(entry, i))
+                       for i in os.listdir(entry))
+            entries.append((os.path.getmtime(meta), size, entry))
+        return entries
+
+    def evict(self):
+        '''
+        Remove least-recently used entries until the cache fits its maximum
+        size.
+        '''
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry in entries:
+            if total <= self._max_size:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+
+    def clear(self):
+        for _, _, entry in self.entries():
+            shutil.rmtree(entry, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-dir', metavar='DIR', required=True,
+                        help='Cache folder [req]')
+    parser.add_argument('-size', metavar='INT', default=MAX_SIZE, type=int,
+                        help='Maximum cache size, bytes [' +
+                        str(MAX_SIZE) + ']')
+    parser.add_argument('--clear', action='store_true',
+                        help='Remove all cached entries [False]')
+    args = vars(parser.parse_args())
+    cache = ParseCache(args['dir'], args['size'])
+    if args['clear']:
+        cache.clear()
+    else:
+        cache.evict()
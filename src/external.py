@@ -0,0 +1,296 @@
+'''
+Enables analysis of BED files larger than memory. BED and annotation files
+are partitioned by chromosome and sorted on-disk in bounded-memory runs.
+Sorted BED entries are then swept, a block at a time, against memory-mapped
+annotations; no more than a fixed number of records are held in memory. Hits
+are written to disk by line-number, so BED files are finally re-read in their
+own order and parsed exactly as they would be in memory.
+'''
+
+import gzip
+import os
+import numpy as np
+from io import BytesIO
+from pandas import DataFrame, read_table
+from pandas.errors import EmptyDataError
+from src import metrics
+from src.intervals import (IntervalIndex, annotation_columns, closest_all,
+                           is_index)
+from src.ioutils import BED_DTYPES, abstract_bed, vectorize_bed
+from src.model import BEDFileFactory, label
+
+RECORD = np.dtype([('key', '<i8'), ('start', '<i8'), ('end', '<i8'),
+                   ('order', '<i8')])
+SHIFT = 32  # sort keys are position << SHIFT | order; order < 2^32
+PARSE_FACTOR = 32  # memory parsing, and writing, vectors relative to text
+
+
+def max_records(memory):
+    '''
+    @param memory: memory ceiling, in megabytes.
+    @return: number of records sorted at a time within the ceiling; runs
+    are copied, and their sort-order derived, hence the factor of four.
+    '''
+
+    return max(int(memory * 1024 ** 2 / (4 * RECORD.itemsize)), 1024)
+
+
+def max_bytes(memory):
+    '''
+    @param memory: memory ceiling, in megabytes.
+    @return: bytes of BED/GTF text parsed at a time within the ceiling;
+    decoding, and then writing, vectors takes many-fold their text.
+    '''
+
+    return max(int(memory * 1024 ** 2 / PARSE_FACTOR), 1 << 16)
+
+
+def iter_text(f, budget):
+    '''
+    Reads a BED/GTF file in chunks of whole lines.
+    @param f: BED/GTF filename; gzip-compressed if it ends with .gz
+    @param budget: bytes per chunk; exceeded by at-most a single line.
+    @return: generator of bytes.
+    '''
+
+    with (gzip.open if f.endswith('.gz') else open)(f, 'rb') as handle:
+        while True:
+            data = handle.read(budget)
+            if not data:
+                return
+            yield data + handle.readline()  # complete the last line
+
+
+def read_text(data, **kwargs):
+    '''
+    @param data: bytes of whole BED/GTF lines.
+    @param kwargs: arguments of read_table.
+    @return: data-frame; None if data has no lines, i.e. only comments.
+    '''
+
+    try:
+        return read_table(BytesIO(data), header=None, sep='\t', **kwargs)
+    except EmptyDataError:
+        return None
+
+
+def partition(f, cols, offset, folder, prefix, budget, comment=None,
+              features=None):
+    '''
+    Partitions a BED/GTF file by chromosome; each partition is a binary
+    file of records, appended to while reading budget bytes at a time.
+    @param f: BED/GTF filename.
+    @param cols: chromosome, start, and end columns.
+    @param offset: 1 given 1-based files, i.e. GTF; otherwise 0.
+    @param folder: folder to save partitions.
+    @param prefix: prefix of each partition filename.
+    @param budget: bytes of text read at a time; see max_bytes.
+    @param comment: character denoting comment lines.
+    @param features: GTF feature types to retain; default all.
+    @return: tuple of a dictionary; chromosome => partition, in order of
+    appearance, and the number of lines read.
+    '''
+
+    parts, seen = {}, 0
+    usecols = cols + [2] if features else cols
+    for data in iter_text(f, budget):
+        df = read_text(data, usecols=usecols, comment=comment,
+                       dtype={cols[0]: str})
+        if df is None:
+            continue
+        order = np.arange(seen, seen + df.shape[0])  # line-numbers
+        seen += df.shape[0]
+        if features:
+            keep = df[2].isin(features).values
+            df, order = df[keep], order[keep]
+        for chrom, rows in df.groupby(cols[0], sort=False).indices.items():
+            if chrom not in parts:
+                parts[chrom] = os.path.join(folder, prefix + '-' +
+                                            str(len(parts)) + '.part')
+            rec = np.zeros(len(rows), dtype=RECORD)
+            rec['start'] = df[cols[1]].values[rows] - offset
+            rec['end'] = df[cols[2]].values[rows]
+            rec['order'] = order[rows]
+            with open(parts[chrom], 'ab') as out:
+                rec.tofile(out)
+    return parts, seen
+
+
+def sort_keys(rec, by):
+    '''
+    @param rec: array of records.
+    @param by: start or end; ties are resolved by ascending order given
+    start, and by descending order given end.
+    @return: array of unique sort keys.
+    '''
+
+    if by == 'start':
+        return (rec['start'] << SHIFT) | rec['order']
+    return (rec['end'] << SHIFT) | ((1 << SHIFT) - 1 - rec['order'])
+
+
+def external_sort(part, fname, by, n):
+    '''
+    Sorts a partition by start or end. Runs of n records are sorted in
+    memory and subsequently merged, with each run read n / #runs records at
+    a time.
+    @param part: partition filename.
+    @param fname: .npy filename to save sorted records.
+    @param by: start or end.
+    @param n: maximum number of records sorted in memory.
+    @return: memory-mapped array of sorted records.
+    '''
+
+    records = np.memmap(part, dtype=RECORD, mode='r')
+    runs = []
+    for i in range(0, len(records), n):
+        run = np.array(records[i:i + n])
+        run['key'] = sort_keys(run, by)
+        run = run[np.argsort(run['key'], kind='stable')]
+        runs.append(fname + '.' + str(len(runs)) + '.npy')
+        np.save(runs[-1], run)
+    if len(runs) == 1:
+        os.rename(runs[0], fname)
+    else:
+        merge(runs, fname, len(records), n)
+    del records
+    return np.load(fname, mmap_mode='r')
+
+
+def merge(runs, fname, total, n):
+    '''
+    Merges sorted runs into a single sorted .npy file. A block of each run
+    is read; every record at-most the smallest last-key, of blocks not
+    reaching the end of their run, is then safe to emit.
+    @param runs: list of .npy filenames; each is sorted.
+    @param fname: .npy filename to save merged records.
+    @param total: number of records across all runs.
+    @param n: maximum number of records held in memory.
+    '''
+
+    sources = [np.load(run, mmap_mode='r') for run in runs]
+    pos, block = [0] * len(sources), max(n // len(sources), 1)
+    out = np.lib.format.open_memmap(fname, mode='w+', dtype=RECORD,
+                                    shape=(total,))
+    done = 0
+    while done < total:
+        blocks = [s[p:p + block] for s, p in zip(sources, pos)]
+        bounds = [b['key'][-1] for s, p, b in zip(sources, pos, blocks)
+                  if p + len(b) < len(s)]
+        emit = []
+        for num, b in enumerate(blocks):
+            count = len(b) if not bounds else\
+                np.searchsorted(b['key'], min(bounds), 'right')
+            emit.append(np.array(b[:count]))
+            pos[num] += count
+        merged = np.concatenate(emit)
+        out[done:done + len(merged)] = merged[np.argsort(merged['key'],
+                                                         kind='stable')]
+        done += len(merged)
+    out.flush()
+    del out, sources
+    for run in runs:
+        os.remove(run)
+
+
+def index_annotation(annot, folder, memory, prefix='annot', features=None):
+    '''
+    Construct an IntervalIndex given a BED/GTF file, whereby annotations of
+    each chromosome are sorted out-of-core and memory-mapped. Saved indexes
+    are already memory-mapped, and are simply loaded.
+    @param annot: BED/GTF filename, or saved IntervalIndex folder.
+    @param folder: folder to save sorted annotations.
+    @param memory: memory ceiling, in megabytes.
+    @param prefix: prefix of each sorted filename.
+    @param features: GTF feature types to index, i.e. gene; default all.
+    @return: object of type IntervalIndex.
+    '''
+
+    if is_index(annot):
+        return IntervalIndex.load(annot, features)
+    cols, offset = annotation_columns(annot)
+    index = IntervalIndex(offset)
+    n = max_records(memory)
+    with metrics.stage('external_index', file=annot):
+        parts, _ = partition(annot, cols, offset, folder, prefix,
+                             max_bytes(memory), '#', features)
+        for chrom, part in parts.items():
+            by_start = external_sort(part, part + '.start.npy', 'start', n)
+            by_end = external_sort(part, part + '.end.npy', 'end', n)
+            os.remove(part)
+            index.attach(chrom, [by_start['start'], by_start['end'],
+                                 by_start['order'], by_end['start'],
+                                 by_end['end'], by_end['order']])
+    return index
+
+
+def closest_sorted(bed, indexes, folder, memory, prefix='bed'):
+    '''
+    Finds the most proximal annotation of every index given each entry of a
+    BED file. Entries are sorted by chromosome and start out-of-core, swept a
+    block at a time, and their hits written to disk by line-number.
+    @param bed: BED filename.
+    @param indexes: list of IntervalIndex objects.
+    @param folder: folder to save sorted entries and hits.
+    @param memory: memory ceiling, in megabytes.
+    @param prefix: prefix of each sorted filename.
+    @return: memory-mapped array; line-number x index x hit start, hit end,
+    and distance.
+    '''
+
+    n = max_records(memory)
+    parts, total = partition(bed, [0, 1, 2], 0, folder, prefix,
+                             max_bytes(memory))
+    hits = np.lib.format.open_memmap(os.path.join(folder, prefix +
+                                                  '.hits.npy'), mode='w+',
+                                     dtype=np.int64,
+                                     shape=(total, len(indexes), 3))
+    for chrom, part in parts.items():
+        entries = external_sort(part, part + '.npy', 'start', n)
+        os.remove(part)
+        for i in range(0, len(entries), n):
+            block = entries[i:i + n]
+            found = closest_all(indexes, DataFrame({'Chr': chrom,
+                                                    'Start': block['start'],
+                                                    'End': block['end']}))
+            for num, arrays in enumerate(found):
+                hits[block['order'], num] = np.column_stack(arrays)
+        del entries
+        os.remove(part + '.npy')
+    return hits
+
+
+def stream_closest(elems, indexes, folder, memory):
+    '''
+    Construct BEDFile objects given many XML elements, each referencing a
+    chunk of BED lines in file order, alongside their hits; see
+    closest_sorted. Chunks are parsed as per BEDFileFactory.build, hence
+    vectors are decoded and filtered identically.
+    @param elems: list of XML elements, i.e. from parse_config.
+    @param indexes: list of IntervalIndex objects.
+    @param folder: folder to save sorted entries and hits.
+    @param memory: memory ceiling, in megabytes.
+    @return: generator of tuples; BEDFile object, and an array of its hits,
+    entry x index x hit start, hit end, and distance.
+    '''
+
+    for num, elem in enumerate(elems):
+        factory = BEDFileFactory(elem)
+        bf = factory.describe()
+        with metrics.stage('external_closest', file=bf.get_file()):
+            hits = closest_sorted(bf.get_file(), indexes, folder, memory,
+                                  'bed' + str(num))
+        seen = 0
+        for data in iter_text(bf.get_file(), max_bytes(memory)):
+            df = read_text(data, dtype=BED_DTYPES)
+            if df is None:
+                continue
+            df.index = np.arange(seen, seen + df.shape[0])  # line-numbers
+            seen += df.shape[0]
+            df = abstract_bed(df)
+            chunk = factory.describe()
+            chunk.set_data(df if bf.is_scalar() else vectorize_bed(df))
+            label(chunk)
+            yield chunk, np.array(hits[chunk.get_data().index.values])
+        del hits
+        os.remove(os.path.join(folder, 'bed' + str(num) + '.hits.npy'))
@@ -0,0 +1,115 @@
+'''
+Persists per-group results, i.e. confidence intervals, p-values, and proximal
+features, so that re-analysis given an amended configuration file recomputes
+only those groups whose BED files or parameters changed. Each group is keyed
+on a fingerprint of its XML elements, the files they reference, and any
+parameters of the analysis.
+'''
+
+import hashlib
+import os
+from src import metrics
+from src.cache import ParseCache, fingerprint
+from src.model import BEDFileFactory
+
+VERSION = 2  # bump whenever the layout of any result changes
+
+
+def stat_fingerprint(f):
+    '''
+    @param f: file or folder; neither is read, only its metadata.
+    @return: tuple of path, size, and modification time of f and, given a
+    folder, of each file it contains.
+    '''
+
+    names = sorted(os.listdir(f)) if os.path.isdir(f) else ['']
+    paths = [os.path.join(f, name) if name else f for name in names]
+    return tuple((os.path.abspath(p), os.stat(p).st_size,
+                  os.stat(p).st_mtime_ns) for p in paths)
+
+
+def element_fingerprint(elem):
+    '''
+    @param elem: XML element, i.e. from parse_config.
+    @return: hexadecimal digest of the element and its BED contents; BigWig
+    files are identified by their metadata as they are never parsed.
+    '''
+
+    bf = BEDFileFactory(elem).describe()
+    bigwigs = [stat_fingerprint(bw) if os.path.exists(bw) else bw
+               for bw in bf.get_bigwigs()]
+    return group_key(fingerprint(bf.get_file(), bf.is_scalar()),
+                     bf.get_tissue(), bf.get_class(), bigwigs)
+
+
+def annotation_fingerprint(annot):
+    '''
+    @param annot: BED/GTF filename, or saved IntervalIndex folder.
+    @return: hexadecimal digest of the annotations.
+    '''
+
+    if os.path.isdir(annot):  # saved indexes are rewritten, not amended
+        return group_key(stat_fingerprint(annot))
+    return fingerprint(annot, True)
+
+
+def group_key(*params):
+    '''
+    @param params: fingerprints and parameters of a group; must be repr-able.
+    @return: hexadecimal digest.
+    '''
+
+    return hashlib.sha1(repr((VERSION,) + params).encode('utf-8')).hexdigest()
+
+
+def group_elements(elems, by):
+    '''
+    @param elems: list of XML elements, i.e. from parse_config.
+    @param by: function mapping a BEDFile object onto its group.
+    @return: dictionary; group => list of element positions within elems,
+    with groups ordered by first appearance.
+    '''
+
+    groups = {}
+    for num, elem in enumerate(elems):
+        groups.setdefault(by(BEDFileFactory(elem).describe()), []).append(num)
+    return groups
+
+
+def open_store(folder):
+    '''
+    @param folder: results folder; incremental analysis is disabled if not
+    provided.
+    @return: object of type ResultStore, or None.
+    '''
+
+    return ResultStore(folder) if folder else None
+
+
+class ResultStore(ParseCache):
+    '''
+    Folder of per-group result data-frames, keyed on group fingerprints
+    rather than BED files; see ParseCache.
+    '''
+    def contains(self, keys):
+        return all(os.path.exists(os.path.join(self._folder, key,
+                                               'meta.json')) for key in keys)
+
+    def recall(self, keys, compute, group=None):
+        '''
+        Retrieve the results of a group, computing and persisting them if
+        any is absent.
+        @param keys: list of keys; one per result.
+        @param compute: function returning a list of data-frames, ordered as
+        per keys.
+        @param group: name of the group, recorded given recomputation.
+        @return: list of data-frames.
+        '''
+        frames = [self.get(key) for key in keys]
+        if any(df is None for df in frames):  # stale; recompute the group
+            with metrics.stage('recompute', group=group):
+                frames = compute()
+            for key, df in zip(keys, frames):
+                self.put(key, df)
+            self.evict()
+        return frames
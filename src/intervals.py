@@ -0,0 +1,315 @@
+'''
+Provides an in-process interval index over BED/GTF annotations. Such an index
+enables lookup of the most proximal annotation given each BED entry without
+relying on external applications, i.e. BEDtools.
+'''
+
+import argparse
+import json
+import os
+import numpy as np
+from pandas import Categorical, read_table
+from src import metrics
+
+NO_HIT = -1  # start, end, and distance given entries lacking any annotation
+INDEX_SUFFIX = '.idx'  # folder suffix of saved IntervalIndex objects
+ARRAYS = ['start_s', 'end_s', 'order_s', 'start_e', 'end_e', 'order_e']
+
+
+def is_index(annot):
+    return annot.rstrip('/').endswith(INDEX_SUFFIX) and os.path.isdir(annot)
+
+
+def annotation_name(annot):
+    '''
+    @param annot: BED/GTF filename, or saved IntervalIndex folder.
+    @return: filename of the annotations; that of the BED/GTF file indexed.
+    '''
+
+    name = os.path.basename(annot.rstrip('/'))
+    return name[:-len(INDEX_SUFFIX)] if name.endswith(INDEX_SUFFIX) else name
+
+
+def annotation_columns(annot):
+    '''
+    @param annot: BED/GTF filename.
+    @return: tuple of chromosome, start, end columns, and start offset.
+    '''
+
+    if annot.endswith('gtf'):
+        return [0, 3, 4], 1  # GTF files are 1-based
+    elif annot.endswith('bed'):
+        return [0, 1, 2], 0
+    raise IOError(annot + ' must either be a BED or GTF file.')
+
+
+class IntervalIndex():
+    '''
+    Per-chromosome sorted-array index of annotation intervals. Lookups mimic
+    `bedtools closest -io -d -t first`; overlapping annotations are ignored,
+    book-ended annotations are 1bp distant, and ties are resolved by whichever
+    annotation occurs first in the annotation file.
+    '''
+    def __init__(self, offset=0):
+        self._chroms = {}  # chromosome => arrays sorted by start and by end
+        self._offset = offset  # 1 given GTF files as they are 1-based
+        self._features = {}  # chromosome => feature codes sorted as above
+        self._feature_names = None  # feature type given each feature code
+        self._genes = None  # gene_id given each annotation, in file order
+
+    @staticmethod
+    def from_file(annot, features=None, attributes=False):
+        '''
+        Construct an IntervalIndex given a BED or GTF file, or given a
+        folder whereby an IntervalIndex was saved.
+        @param annot: BED/GTF filename, or saved IntervalIndex folder.
+        @param features: GTF feature types to index, i.e. gene; default all.
+        @param attributes: whether to also index feature types and gene_id.
+        @return: object of type IntervalIndex.
+        '''
+        if is_index(annot):
+            return IntervalIndex.load(annot, features)
+        cols, offset = annotation_columns(annot)
+        if (features or attributes) and offset == 0:
+            raise IOError('Feature types are only present in GTF files.')
+        usecols = cols + ([2] if features or attributes else []) +\
+            ([8] if attributes else [])
+        with metrics.stage('index', file=annot) as record:
+            df = read_table(annot, header=None, sep='\t', usecols=usecols,
+                            comment='#', dtype={cols[0]: str})
+            index = IntervalIndex(offset)
+            order = np.arange(df.shape[0])  # line-number resolving ties
+            codes = None
+            if attributes:  # feature types are mapped to integer codes
+                types = Categorical(df[2])
+                codes = types.codes
+                index._feature_names = [str(i) for i in types.categories]
+                index._genes = df[8].str.extract(r'gene_id "([^"]*)"',
+                                                 expand=False).fillna('')
+                index._genes = np.asarray(index._genes, dtype=str)
+            if features:
+                keep = df[2].isin(features).values
+                df, order = df[keep], order[keep]
+                codes = None if codes is None else codes[keep]
+            record['rows'] = df.shape[0]
+            groups = df.groupby(cols[0], sort=False).indices
+            for chrom, rows in groups.items():
+                index.add(chrom, df[cols[1]].values[rows] - offset,
+                          df[cols[2]].values[rows], order[rows],
+                          None if codes is None else codes[rows])
+        return index
+
+    @staticmethod
+    def from_frame(df):
+        '''
+        Construct an IntervalIndex given BED contents that are already
+        parsed; ties are resolved by row-number.
+        @param df: data-frame containing Chr, Start, and End columns.
+        @return: object of type IntervalIndex.
+        '''
+        index = IntervalIndex()
+        order = np.arange(df.shape[0])
+        starts = df['Start'].values.astype(np.int64)
+        ends = df['End'].values.astype(np.int64)
+        chroms = df['Chr'].astype(str).values
+        for chrom, rows in df.groupby(chroms, sort=False).indices.items():
+            index.add(chrom, starts[rows], ends[rows], order[rows])
+        return index
+
+    @staticmethod
+    def load(folder, features=None):
+        '''
+        Construct an IntervalIndex given a folder whereby it was saved. All
+        arrays are memory-mapped rather than read.
+        @param folder: saved IntervalIndex folder.
+        @param features: GTF feature types to index, i.e. gene; default all.
+        @return: object of type IntervalIndex.
+        '''
+        with open(os.path.join(folder, 'meta.json')) as handle:
+            meta = json.load(handle)
+        index = IntervalIndex(meta['offset'])
+        arrays = [np.load(os.path.join(folder, name + '.npy'), 'r')
+                  for name in ARRAYS]
+        if features:
+            if meta['features'] is None:
+                raise IOError(folder + ' does not reference feature types.')
+            codes = [num for num, name in enumerate(meta['features'])
+                     if name in features]
+            f_s = np.load(os.path.join(folder, 'feature_s.npy'), 'r')
+            f_e = np.load(os.path.join(folder, 'feature_e.npy'), 'r')
+        bounds = meta['bounds']
+        for chrom, lo, hi in zip(meta['chroms'], bounds[:-1], bounds[1:]):
+            sliced = [arr[lo:hi] for arr in arrays]
+            if features:  # masking retains the sort-order
+                by_s, by_e = np.isin(f_s[lo:hi], codes), np.isin(f_e[lo:hi],
+                                                                 codes)
+                sliced = [arr[by_s] for arr in sliced[:3]] +\
+                    [arr[by_e] for arr in sliced[3:]]
+            if len(sliced[0]) > 0:
+                index.attach(chrom, sliced)
+        if os.path.exists(os.path.join(folder, 'genes.npy')):
+            index._genes = np.load(os.path.join(folder, 'genes.npy'), 'r')
+        return index
+
+    def save(self, folder):
+        '''
+        Save this IntervalIndex to a folder of memory-mappable arrays.
+        @param folder: folder to save the index; should end with .idx
+        '''
+        os.makedirs(folder, exist_ok=True)
+        chroms = self.chromosomes()
+        bounds = np.cumsum([0] + [len(self._chroms[c][0]) for c in chroms])
+        for num, name in enumerate(ARRAYS):
+            np.save(os.path.join(folder, name + '.npy'),
+                    concat_arrays([self._chroms[c][num] for c in chroms]))
+        if self._feature_names is not None:
+            for num, name in enumerate(['feature_s', 'feature_e']):
+                np.save(os.path.join(folder, name + '.npy'),
+                        concat_arrays([self._features[c][num]
+                                       for c in chroms]))
+        if self._genes is not None:
+            np.save(os.path.join(folder, 'genes.npy'), self._genes)
+        with open(os.path.join(folder, 'meta.json'), 'w') as handle:
+            json.dump({'offset': self._offset, 'chroms': chroms,
+                       'bounds': bounds.tolist(),
+                       'features': self._feature_names}, handle)
+
+    def add(self, chrom, starts, ends, order, features=None):
+        '''
+        Index annotations of a single chromosome.
+        @param chrom: chromosome name.
+        @param starts: 0-based start indices.
+        @param ends: end indices.
+        @param order: annotation order within its file.
+        @param features: feature type code of each annotation.
+        '''
+        by_start = np.lexsort((order, starts))  # first-occurring is leftmost
+        by_end = np.lexsort((-order, ends))  # first-occurring is rightmost
+        self._chroms[str(chrom)] = (starts[by_start], ends[by_start],
+                                    order[by_start], starts[by_end],
+                                    ends[by_end], order[by_end])
+        if features is not None:
+            self._features[str(chrom)] = (features[by_start],
+                                          features[by_end])
+
+    def attach(self, chrom, arrays):
+        '''
+        Index annotations of a single chromosome given arrays that are
+        already sorted, i.e. memory-mapped arrays sorted out-of-core.
+        @param chrom: chromosome name.
+        @param arrays: starts, ends, and order sorted by start, followed by
+        starts, ends, and order sorted by end.
+        '''
+        self._chroms[str(chrom)] = tuple(arrays)
+
+    def chromosomes(self):
+        return list(self._chroms.keys())
+
+    def get_genes(self):
+        '''
+        @return: gene_id of each annotation, in file order; None if absent.
+        '''
+        return self._genes
+
+    def closest(self, df):
+        '''
+        Find the most proximal, non-overlapping, annotation for every entry
+        of a BED data-frame; each chromosome is queried in a single batch.
+        @param df: data-frame containing Chr, Start, and End columns.
+        @return: tuple of hit start, hit end, and distance arrays.
+        '''
+        return closest_all([self], df)[0]
+
+    def query(self, chrom, a_start, a_end):
+        '''
+        Find the most proximal, non-overlapping, annotation given entries of
+        a single chromosome.
+        @param chrom: chromosome name.
+        @param a_start: start indices of entries.
+        @param a_end: end indices of entries.
+        @return: tuple of hit start, hit end, and distance arrays; None if
+        the chromosome has no annotations.
+        '''
+        if chrom not in self._chroms:
+            return None  # no annotations on this chromosome
+        s_s, e_s, o_s, s_e, e_e, o_e = self._chroms[chrom]
+        never = np.iinfo(np.int64).max  # distance given a missing neighbor
+        right = np.searchsorted(s_s, a_end, 'left')  # start >= entry end
+        left = np.searchsorted(e_e, a_start, 'right') - 1  # end <= start
+        has_r, has_l = right < len(s_s), left >= 0
+        right, left = np.minimum(right, len(s_s) - 1), np.maximum(left, 0)
+        d_r = np.where(has_r, s_s[right] - a_end + 1, never)
+        d_l = np.where(has_l, a_start - e_e[left] + 1, never)
+        use_r = (d_r < d_l) | ((d_r == d_l) & (o_s[right] < o_e[left]))
+        found = has_r | has_l
+        hs = np.where(use_r, s_s[right], s_e[left]) + self._offset
+        he = np.where(use_r, e_s[right], e_e[left])
+        return (np.where(found, hs, NO_HIT), np.where(found, he, NO_HIT),
+                np.where(found, np.minimum(d_r, d_l), NO_HIT))
+
+
+def concat_arrays(arrays):
+    return np.concatenate(arrays) if arrays else np.empty(0, dtype=np.int64)
+
+
+def closest_all(indexes, df):
+    '''
+    Find the most proximal, non-overlapping, annotation of every index given
+    each entry of a BED data-frame. Entries are grouped by chromosome once,
+    and each group is then queried against all indexes.
+    @param indexes: list of IntervalIndex objects.
+    @param df: data-frame containing Chr, Start, and End columns.
+    @return: list of tuples; hit start, hit end, and distance arrays per index.
+    '''
+
+    n = df.shape[0]
+    hits = [tuple(np.full(n, NO_HIT, dtype=np.int64) for _ in range(3))
+            for _ in indexes]
+    chroms = df['Chr'].astype(str).values
+    starts, ends = df['Start'].values, df['End'].values
+    for chrom, rows in df.groupby(chroms, sort=False).indices.items():
+        a_start, a_end = starts[rows], ends[rows]
+        for index, out in zip(indexes, hits):
+            found = index.query(chrom, a_start, a_end)
+            if found is None:
+                continue
+            for arr, values in zip(out, found):
+                arr[rows] = values
+    return hits
+
+
+def main(args):
+    '''
+    Builds the interval index of an annotations file and saves it, such that
+    it can be given to -annot in place of the file itself.
+    @param args: dictionary of command-line arguments.
+    '''
+
+    gtf = annotation_columns(args['annot'])[1] == 1
+    index = IntervalIndex.from_file(args['annot'], attributes=gtf)
+    out = args['out'] or args['annot']
+    index.save(out if out.endswith(INDEX_SUFFIX) else out + INDEX_SUFFIX)
+
+
+def arguments(parser):
+    '''
+    Adds the command-line arguments of this script.
+    @param parser: argparse.ArgumentParser object.
+    @return: the same parser.
+    '''
+
+    parser.add_argument('-annot', metavar='FILE', required=True,
+                        help='BED/GTF annotations file [req]')
+    parser.add_argument('-out', metavar='DIR', default=None,
+                        help='Folder to save the index [FILE.idx]')
+    return parser
+
+
+if __name__ == '__main__':
+    try:
+        args = vars(arguments(argparse.ArgumentParser()).parse_args())
+        main(args)
+    except KeyboardInterrupt:
+        print()
+    except IOError as e:
+        print(e)
@@ -3,54 +3,127 @@ Enables parsing of all user-provided input files, namely the configuration
 file and all accompanying BED files.
 '''
 
+import gzip
 import os
-import random
+import sys
+import numpy as np
+from io import BytesIO
+from itertools import islice
 from xml.etree import ElementTree
-from pandas import read_table
+from pandas import DataFrame, concat, read_table
 from subprocess import Popen, PIPE
-from Bio import SeqIO
+from src import metrics
 
-
-def exec_closest_app(bed, annot):
-    cmd = 'bedtools closest -io -d -a ' + bed + ' -b ' + annot + ' -t first'
-    out, err = Popen(cmd, shell=True, stdout=PIPE).communicate()
-    if err:
-        raise IOError('Exception raised running bedtools')
-    return out
+BED_DTYPES = {0: 'category', 1: 'int32', 2: 'int32'}  # chr, start, end
+FORMATS = ['csv', 'parquet', 'feather', 'npz']  # formats of results
 
 
-def exec_average_app(chrom, start, end, bigwig):
+def exec_average_app(bed, bigwig):
+    '''
+    Averages a BigWig file over every region of a BED file in a single call.
+    Each region must be named (4th column) so its average can be joined back.
+    @param bed: BED filename; regions to average over.
+    @param bigwig: BigWig filename.
+    @return: bigWigAverageOverBed output; name, size, covered, sum, means.
+    '''
     if not os.path.exists(bigwig):  # signaling is sought but file is invalid
         raise IOError(bigwig + ' is an invalid BigWig file.')
-    cmd = 'echo ' + chrom + ' ' + str(start) + ' ' + str(end) +\
-             ' 1 | bigWigAverageOverBed ' + bigwig + ' stdin stdout'
-    out, err = Popen(cmd, shell=True, stdout=PIPE).communicate()
-    if err:  # stdout, stderr are outputs; stderr must be None
+    cmd = ['bigWigAverageOverBed', bigwig, bed, 'stdout']
+    proc = Popen(cmd, stdout=PIPE)
+    metrics.count_subprocess()
+    out, err = proc.communicate()
+    if err or proc.returncode:  # stdout, stderr are outputs; stderr is None
         raise IOError('Error found following mapping features to BED')
     return out
 
 
-def build_random_bed(fasta, n, l=400):
+def index_fasta(fasta):
+    '''
+    Derives the .fai index of a FASTA file, i.e. as per samtools faidx. The
+    index is saved alongside the FASTA file and re-used thereafter, unless
+    the FASTA file has since been modified. Only one line is read at a time.
+    @param fasta: FASTA filename.
+    @return: data-frame referencing each sequence name and its length.
+    '''
+
+    fai = fasta + '.fai'
+    stale = not os.path.exists(fai) or\
+        os.path.getmtime(fai) < os.path.getmtime(fasta)
+    if not stale:
+        return read_table(fai, header=None, sep='\t', usecols=[0, 1],
+                          names=['Name', 'Length'], dtype={0: str})
+    rows, offset, seq = [], 0, None
+    with open(fasta, 'rb') as handle:
+        for line in handle:
+            offset += len(line)
+            if line.startswith(b'>'):  # name, length, offset, bases, width
+                seq = [line[1:].split()[0].decode('utf-8'), 0, offset, 0, 0]
+                rows.append(seq)
+            elif seq is not None and line.strip():
+                if seq[3] == 0:  # line-length is that of its first line
+                    seq[3], seq[4] = len(line.rstrip(b'\r\n')), len(line)
+                seq[1] += len(line.rstrip(b'\r\n'))
+    df = DataFrame(rows, columns=['Name', 'Length', 'Offset', 'Bases',
+                                  'Width'])
+    try:
+        df.to_csv(fai, sep='\t', header=False, index=False)
+    except IOError:
+        pass  # FASTA folder is read-only; index is simply not re-used
+    return df[['Name', 'Length']]
+
+
+def build_random_bed(fasta, n, l=400, fname='./bedfile.bed', seed=None):
     '''
     Create a new BED file that is build solely given randomly-selected
-    genomic coordinates from a FASTA file. The corresponding BED filename
-    will be bedfile.bed, and will be saved in the current working directory.
+    genomic coordinates from a FASTA file. Sequences are selected relative
+    to their length, and each entry lies entirely within its sequence.
     @param fasta: FASTA filename.
     @param n: Number of randomly-selected BED entries to make.
     @param l: Length of each randomly-selected genomic sequence.
+    @param fname: BED filename to save entries; default is ./bedfile.bed
+    @param seed: Seed for reproducible selections.
+    @return: BED filename.
     '''
 
-    fname = './bedfile.bed'
-    out = open(fname, 'w')
-    records = list(SeqIO.parse(open(fasta), 'fasta'))
-    for _ in range(n):
-        record = random.choice(records)
-        chrm = record.description
-        start = random.randint(0, len(record.seq))
-        out.write(chrm + '\t' + str(start) + '\t' + str(start + l) + '\n')
+    with metrics.stage('random_bed', file=fasta, rows=n):
+        return _build_random_bed(fasta, n, l, fname, seed)
+
+
+def _build_random_bed(fasta, n, length, fname, seed):
+    index = index_fasta(fasta)
+    chrm, start = random_regions(index['Length'].values, np.full(n, length),
+                                 np.random.default_rng(seed))
+    DataFrame({'Chr': index['Name'].values[chrm], 'Start': start,
+               'End': start + length}).to_csv(fname, sep='\t',
+                                              header=False, index=False)
     return fname
 
 
+def random_regions(sizes, lengths, rng):
+    '''
+    Selects random regions, each lying entirely within its sequence.
+    Sequences are selected relative to their number of valid starts, given
+    each distinct region length.
+    @param sizes: numpy array; length of each sequence.
+    @param lengths: numpy array; length of each region.
+    @param rng: numpy random Generator.
+    @return: tuple of sequence indices and start indices.
+    '''
+
+    chrm = np.empty(len(lengths), dtype=np.int64)
+    start = np.empty(len(lengths), dtype=np.int64)
+    for length in np.unique(lengths):
+        rows = np.flatnonzero(lengths == length)
+        positions = np.maximum(sizes - length + 1, 0)  # valid starts
+        if positions.sum() == 0:
+            raise IOError('No sequence is ' + str(length) + 'bp long.')
+        chrm[rows] = rng.choice(len(positions), size=len(rows),
+                                p=positions / positions.sum())
+        start[rows] = (rng.random(len(rows)) *
+                       positions[chrm[rows]]).astype(np.int64)
+    return chrm, start
+
+
 def mkdir(folder):
     try:
         os.makedirs(folder)
@@ -65,8 +138,10 @@ def parse_config(xml):
     @return: list of XML objects referencing BEDFile elements.
     '''
 
-    tree = ElementTree.parse(xml)
-    return list(tree.iter('bed'))
+    with metrics.stage('parse_config', file=xml) as record:
+        elems = list(ElementTree.parse(xml).iter('bed'))
+        record['rows'] = len(elems)
+    return elems
 
 
 def parse_abstract_bed(f):
@@ -77,7 +152,16 @@ def parse_abstract_bed(f):
     @param f: BED file.
     '''
 
-    df = read_table(f, header=None, sep='\t')  # BED files have no header
+    df = read_table(f, header=None, sep='\t', dtype=BED_DTYPES)  # no header
+    return abstract_bed(df)
+
+
+def abstract_bed(df):
+    '''
+    Names the columns of raw BED contents and inserts each entry length.
+    @param df: data-frame of raw BED contents.
+    '''
+
     df.insert(3, None, df[2] - df[1])  # insert BED entry length
     colnames = ['Chr', 'Start', 'End', 'Length']
     names = colnames + list(range(df.shape[1] - len(colnames)))
@@ -85,24 +169,295 @@ def parse_abstract_bed(f):
     return df
 
 
+def parse_vector_buffer(vectors):
+    '''
+    Decodes a collection of comma-separated vector strings into a single
+    contiguous buffer. Missing values, i.e. n/a or nan, are set to zero.
+    @param vectors: collection of comma-separated vector strings.
+    @return: tuple of float32 buffer and offsets; vector i is referenced by
+    buffer[offsets[i]:offsets[i + 1]].
+    '''
+
+    if len(vectors) == 0:
+        return np.empty(0, dtype=np.float32), np.zeros(1, dtype=np.int64)
+    text = '\n'.join(vectors).replace('n/a', '0')
+    raw = np.frombuffer(text.encode('ascii'), dtype=np.uint8)
+    ends = np.append(np.flatnonzero(raw == ord('\n')), raw.size - 1)
+    commas = np.cumsum(raw == ord(','))[ends]  # commas up to each vector end
+    counts = np.diff(commas, prepend=0) + 1  # values per vector
+    try:  # numpy 2 raises, rather than truncates, given unparsable values
+        buf = np.fromstring(text.replace('\n', ','), dtype=np.float32,
+                            sep=',')
+    except ValueError:
+        raise IOError('Malformed vector found in BED file.')
+    if buf.size != counts.sum():
+        raise IOError('Malformed vector found in BED file.')
+    buf[np.isnan(buf)] = 0
+    return buf, np.concatenate(([0], np.cumsum(counts)))
+
+
 def parse_vectorized_bed(f):
     '''
     Parses a BED file whereby the last column is exclusively dedicated to
     referencing a vector of values. Such a vector may reference conservation
     scores or gene-expression signals per base of the BED  Thus, due to the
-    granularity of this vector, addition computation is required.
+    granularity of this vector, addition computation is required. All vectors
+    are decoded into a single float32 buffer; each Vectors entry is a view.
     @param f: BED file.
     '''
 
-    df = parse_abstract_bed(f)  # vectors are the last column (other)
-    vector_data = df[df.columns[-1]].astype('str')  # last column is vector
-    all_vectors = []
-    for vector in vector_data:
-        vector = [float(i) if i != 'n/a' else 0.0 for i in vector.split(',')]
-        vector[vector == 'nan'] = 0
-        all_vectors.append(vector)
-    df['Vectors'] = all_vectors  # add vectors to the actual data-frame
-    df['Vector_Length'] = [len(vector) for vector in df['Vectors']]
-    df = df[df['Length'] == df['Vector_Length']]  # length must match vector
-    df = df[df['Length'] % 100 == 0]  # only save divisible entries
+    return vectorize_bed(parse_abstract_bed(f))
+
+
+def vectorize_bed(df):
+    '''
+    Decodes the vector column of abstract BED contents; entries whose length
+    does not match their vector, or is not divisible by 100, are removed. The
+    vector text is dropped once decoded as it dwarfs all other columns.
+    @param df: data-frame of abstract BED contents.
+    '''
+
+    text = df.columns[-1]  # last column is vector
+    vector_data = df[text].astype('str')
+    buf, offsets = parse_vector_buffer(vector_data.values)
+    counts = np.diff(offsets)
+    lengths = df['Length'].values
+    keep = (lengths == counts) & (lengths % 100 == 0)  # length must match
+    buf = buf[np.repeat(keep, counts)]  # only save divisible entries
+    offsets = np.concatenate(([0], np.cumsum(counts[keep])))
+    df = df.loc[keep, df.columns != text].copy()
+    df['Vectors'] = [buf[i:j] for i, j in zip(offsets[:-1], offsets[1:])]
+    df['Vector_Length'] = counts[keep].astype(np.int32)
     return df
+
+
+def iter_bed(f, is_scalar, chunksize):
+    '''
+    Parses a BED file in chunks so that only a fixed number of BED lines are
+    held in memory. Each chunk is parsed identically to the entire file.
+    @param f: BED file.
+    @param is_scalar: whether the BED file is scalar.
+    @param chunksize: number of BED lines per chunk.
+    '''
+
+    for df in read_table(f, header=None, sep='\t', dtype=BED_DTYPES,
+                         chunksize=chunksize):
+        df = abstract_bed(df)
+        yield df if is_scalar else vectorize_bed(df)
+
+
+def iter_lengths(f, is_scalar, chunksize):
+    '''
+    Derives BED entry lengths in chunks, parsing only start and end indices.
+    Vectors are never decoded; the commas of each raw vector are simply
+    counted so entries are removed exactly as per vectorize_bed.
+    @param f: BED file; gzip-compressed if it ends with .gz
+    @param is_scalar: whether the BED file is scalar.
+    @param chunksize: number of BED lines per chunk.
+    @return: generator of numpy arrays; the length of each entry.
+    '''
+
+    dtype = {1: np.int64, 2: np.int64}
+    if is_scalar:  # no vectors to count
+        for df in read_table(f, header=None, sep='\t', usecols=[1, 2],
+                             dtype=dtype, chunksize=chunksize):
+            yield df[2].values - df[1].values
+        return
+    with (gzip.open if f.endswith('.gz') else open)(f, 'rb') as handle:
+        while True:
+            lines = [i for i in islice(handle, chunksize) if i.strip()]
+            if not lines:
+                return
+            df = read_table(BytesIO(b''.join(lines)), header=None, sep='\t',
+                            usecols=[1, 2], dtype=dtype)
+            lengths = df[2].values - df[1].values
+            counts = np.fromiter((i.count(b',', i.rfind(b'\t') + 1) + 1
+                                  for i in lines), np.int64, len(lines))
+            yield lengths[(lengths == counts) & (lengths % 100 == 0)]
+
+
+def write_csv(df, out, header=True):
+    '''
+    Writes a data-frame as CSV; vectors are rendered as lists of values.
+    @param df: data-frame to write.
+    @param out: file-like object, i.e. standard-output.
+    @param header: whether to write column names.
+    '''
+
+    if 'Vectors' in df.columns:
+        df = df.assign(Vectors=['[' + ', '.join(map(str, v)) + ']'
+                                for v in df['Vectors']])
+    df.to_csv(out, index=False, header=header)
+
+
+def vector_buffer(vectors):
+    '''
+    @param vectors: collection of numpy arrays.
+    @return: tuple of float32 buffer and offsets; vector i is referenced by
+    buffer[offsets[i]:offsets[i + 1]].
+    '''
+
+    lengths = [len(v) for v in vectors]
+    buf = np.empty(sum(lengths), dtype=np.float32)
+    if lengths:
+        np.concatenate(list(vectors), out=buf, casting='same_kind')
+    return buf, np.concatenate(([0], np.cumsum(lengths, dtype=np.int64)))
+
+
+def arrow_table(df):
+    '''
+    @param df: data-frame of results.
+    @return: pyarrow Table; vectors are lists of float32 values, and
+    categorical columns are strings so that chunks share a schema.
+    '''
+
+    try:
+        import pyarrow as pa
+    except ImportError:
+        raise IOError('Parquet and Feather results require pyarrow.')
+    columns = []
+    for name in df.columns:
+        if name == 'Vectors':
+            buf, offsets = vector_buffer(df['Vectors'])
+            columns.append(pa.LargeListArray.from_arrays(offsets, buf))
+        elif df[name].dtype.name == 'category':
+            columns.append(pa.array(df[name].astype(str).values))
+        else:
+            columns.append(pa.Array.from_pandas(df[name]))
+    return pa.Table.from_arrays(columns, names=[str(i) for i in df.columns])
+
+
+def npz_arrays(df):
+    '''
+    @param df: data-frame of results.
+    @return: dictionary of numpy arrays; one per column, with vectors saved
+    as a float32 buffer (Vectors) and its offsets (Vectors_offsets).
+    '''
+
+    arrays = {}
+    for name in df.columns:
+        if name == 'Vectors':
+            arrays['Vectors'], arrays['Vectors_offsets'] =\
+                vector_buffer(df['Vectors'])
+        elif df[name].dtype.kind in 'biuf':
+            arrays[str(name)] = df[name].values
+        else:  # categorical, or strings; saved without pickling
+            arrays[str(name)] = np.asarray(df[name].astype(str), dtype=str)
+    return arrays
+
+
+def parse_arguments(parser, argv=None):
+    '''
+    Parses the command-line arguments of a script; results formats other
+    than CSV are rejected without -out before any BED file is parsed.
+    @param parser: argparse.ArgumentParser object.
+    @param argv: list of arguments; those of sys.argv if None.
+    @return: dictionary of command-line arguments.
+    '''
+
+    args = vars(parser.parse_args(argv))
+    if args.get('format', 'csv') != 'csv' and args.get('out') is None:
+        parser.error(args['format'] + ' results must be written to a file '
+                     'given -out.')
+    return args
+
+
+def write_results(df, out=None, fmt='csv'):
+    '''
+    Writes a data-frame of results in its entirety; see ResultWriter.
+    @param df: data-frame of results.
+    @param out: filename; standard-output if None, given CSV.
+    @param fmt: csv, parquet, feather, or npz.
+    '''
+
+    with open_writer(out, fmt) as writer:
+        writer.write(df)
+
+
+def open_writer(out=None, fmt='csv'):
+    '''
+    @param out: filename; standard-output if None, given CSV.
+    @param fmt: csv, parquet, feather, or npz.
+    @return: object of type ResultWriter.
+    '''
+
+    return ResultWriter(out, fmt)
+
+
+class ResultWriter():
+    '''
+    Writes data-frames of results, one after another as they are produced,
+    as CSV, Parquet, Feather, or NPZ. Each data-frame is a row group given
+    Parquet, and a record batch given Feather. Vectors are written as lists
+    of float32 values, other than CSV whereby they are rendered as text.
+    NPZ files cannot be appended to and are therefore saved once closed.
+    '''
+    def __init__(self, out=None, fmt='csv'):
+        if fmt not in FORMATS:
+            raise IOError('Format must be one of ' + ', '.join(FORMATS))
+        if out is None and fmt != 'csv':
+            raise IOError(fmt + ' results must be written to a file.')
+        self._out = out
+        self._format = fmt
+        self._handle = None  # CSV file, or Parquet/Feather writer
+        self._schema = None  # that of the first chunk given Parquet/Feather
+        self._frames = []  # data-frames to save given NPZ
+
+    def write(self, df):
+        if self._format == 'csv':
+            header = self._handle is None  # column names are written once
+            if self._handle is None:
+                self._handle = sys.stdout if self._out is None else\
+                    open(self._out, 'w')
+            write_csv(df, self._handle, header)
+        elif self._format == 'npz':
+            self._frames.append(df)
+        else:
+            table = arrow_table(df)
+            if self._handle is None:
+                self._schema = table.schema
+                self._handle = self._open_arrow()
+            self._handle.write_table(table.cast(self._schema))
+
+    def _open_arrow(self):
+        import pyarrow.ipc
+        import pyarrow.parquet
+        if self._format == 'parquet':
+            return pyarrow.parquet.ParquetWriter(self._out, self._schema)
+        return pyarrow.ipc.new_file(self._out, self._schema)  # Feather V2
+
+    def close(self):
+        if self._format == 'npz':
+            frames = [df for df in self._frames if df.shape[0] > 0]
+            df = concat(frames, ignore_index=True) if frames else\
+                (self._frames[0] if self._frames else DataFrame())
+            with open(self._out, 'wb') as handle:  # no .npz is appended
+                np.savez(handle, **npz_arrays(df))
+            self._frames = []
+        elif self._handle is not None and self._handle is not sys.stdout:
+            self._handle.close()
+        self._handle = None
+
+    def discard(self):
+        '''
+        Closes without saving pending results; a file already written to is
+        removed rather than left incomplete.
+        '''
+        self._frames = []
+        if self._handle is None or self._handle is sys.stdout:
+            self._handle = None
+            return
+        try:
+            self._handle.close()
+        finally:
+            self._handle = None
+            os.remove(self._out)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:  # a failed analysis leaves no partial results file
+            self.discard()
@@ -0,0 +1,107 @@
+'''
+Instruments analytical stages, i.e. parsing, feature mapping, and statistics.
+Once configured, each stage records its wall time, rows processed, number of
+subprocesses spawned, and peak resident memory as a JSON line. Peak memory is
+that of the process lifetime thus far, and of its largest child, rather than
+that of the stage alone. Stages may also be profiled, whereby a cProfile dump
+is saved per stage.
+'''
+
+import cProfile
+import json
+import os
+import resource
+import sys
+import time
+from contextlib import contextmanager
+
+_state = {'out': None, 'profile': None, 'depth': 0, 'subprocesses': 0,
+          'dumps': 0}
+
+
+def configure(fname=None, profile=None):
+    '''
+    Enables instrumentation; metrics are appended to a file, and cProfile
+    dumps are saved in a folder.
+    @param fname: JSON lines filename; metrics are not recorded if None.
+    @param profile: folder to save cProfile dumps; not profiled if None.
+    '''
+
+    if fname:
+        _state['out'] = open(fname, 'a', buffering=1)  # a line per stage
+    if profile:
+        os.makedirs(profile, exist_ok=True)
+        _state['profile'] = profile
+
+
+@contextmanager
+def configured(fname=None, profile=None):
+    '''
+    Enables instrumentation for a block alone, i.e. a single daemon request;
+    the prior configuration is restored afterwards. See configure.
+    @param fname: JSON lines filename; that configured prior if None.
+    @param profile: folder to save cProfile dumps; that configured prior if
+    None.
+    '''
+
+    prior = _state['out'], _state['profile']
+    configure(fname, profile)
+    try:
+        yield
+    finally:
+        if _state['out'] is not prior[0]:
+            _state['out'].close()
+        _state['out'], _state['profile'] = prior
+
+
+def count_subprocess(n=1):
+    _state['subprocesses'] += n
+
+
+def peak_rss():
+    '''
+    Both peaks are high-water marks over the lifetime of the process, not
+    of any one stage; they only grow as stages complete.
+    @return: tuple of peak resident memory (bytes) of this process, and of
+    the largest of its reaped children.
+    '''
+
+    scale = 1 if sys.platform == 'darwin' else 1024  # Linux reports KB
+    return (scale * resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            scale * resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+
+@contextmanager
+def stage(name, **fields):
+    '''
+    Records metrics of a stage; the yielded dictionary may be updated, i.e.
+    with the number of rows processed.
+    @param name: name of the stage.
+    @param fields: additional fields to record, i.e. the BED file.
+    '''
+
+    record = dict({'stage': name, 'rows': None}, **fields)
+    if _state['out'] is None and _state['profile'] is None:
+        yield record  # instrumentation is disabled
+        return
+    profiler = None
+    if _state['profile'] and _state['depth'] == 0:  # profile outer stages
+        profiler = cProfile.Profile()
+        profiler.enable()
+    _state['depth'] += 1
+    spawned, start = _state['subprocesses'], time.perf_counter()
+    try:
+        yield record
+    finally:
+        record['seconds'] = time.perf_counter() - start
+        record['subprocesses'] = _state['subprocesses'] - spawned
+        record['peak_rss'], record['peak_rss_children'] = peak_rss()
+        record['pid'] = os.getpid()
+        _state['depth'] -= 1
+        if profiler is not None:
+            profiler.disable()
+            _state['dumps'] += 1
+            profiler.dump_stats(os.path.join(_state['profile'], '%s-%d-%d.prof'
+                                % (name, os.getpid(), _state['dumps'])))
+        if _state['out'] is not None:
+            _state['out'].write(json.dumps(record, default=str) + '\n')
@@ -6,9 +6,15 @@ BED contents.
 
 import os
 from ast import literal_eval  # for translating 'True' to boolean True
+from concurrent.futures import ProcessPoolExecutor
 from xml.etree.ElementTree import Element
-from src import ioutils
-from pandas import concat
+from src import ioutils, metrics
+from src.regions import RegionIndex
+import numpy as np
+from functools import reduce
+from pandas import Categorical, Index, concat
+
+CATEGORICAL = ['Chr', 'Tissue', 'Class']  # columns of few, repeated values
 
 
 class BEDFileFactory():
@@ -22,9 +28,10 @@ class BEDFileFactory():
         assert isinstance(elem, Element)  # element must be an XML object.
         self._element = elem
 
-    def build(self):
+    def describe(self):
         '''
-        Construct a BEDFile object given its own respective XML element.
+        Construct a BEDFile object given its own respective XML element;
+        its BED contents, however, are not parsed.
         @return: object of type BEDFile.
         '''
         bf = BEDFile()
@@ -34,20 +41,199 @@ class BEDFileFactory():
         bf.set_tissue(self.element().find('tissue').text)
         bf.set_bigwigs([i.text for i in self.element().iter('bw')])
         bf.set_is_scalar(literal_eval(self.element().find('is_scalar').text))
+        return bf
+
+    def build(self, cache=None):
+        '''
+        Construct a BEDFile object given its own respective XML element.
+        @param cache: ParseCache object; parsed BED contents are re-used.
+        @return: object of type BEDFile.
+        '''
+        bf = self.describe()
         if bf.is_scalar():  # only save actual BED details; nothing else
-            bf.set_data(ioutils.parse_abstract_bed(bf.get_file()))
+            parse = ioutils.parse_abstract_bed
         else:
-            bf.set_data(ioutils.parse_vectorized_bed(bf.get_file()))
-        bf.get_data()['Tissue'] = bf.get_tissue()  # add information to BED
-        bf.get_data()['Class'] = bf.get_class()
+            parse = ioutils.parse_vectorized_bed
+        with metrics.stage('build', file=bf.get_file()) as record:
+            if cache is None:
+                bf.set_data(parse(bf.get_file()))
+            else:
+                bf.set_data(cache.fetch(bf.get_file(), bf.is_scalar(),
+                                        parse))
+            record['rows'] = bf.get_data().shape[0]
+        label(bf)  # add information to BED
+        return bf
+
+    def stream(self, chunksize):
+        '''
+        Construct BEDFile objects given its own respective XML element, each
+        referencing at-most chunksize consecutive BED lines. Only one chunk
+        of BED contents is therefore held in memory at a time.
+        @param chunksize: number of BED lines per BEDFile object.
+        @return: generator of BEDFile objects.
+        '''
+        bf = self.describe()
+        chunks = ioutils.iter_bed(bf.get_file(), bf.is_scalar(), chunksize)
+        while True:
+            with metrics.stage('stream', file=bf.get_file()) as record:
+                data = next(chunks, None)
+                record['rows'] = 0 if data is None else data.shape[0]
+            if data is None:
+                return
+            chunk = self.describe()
+            chunk.set_data(data)
+            label(chunk)
+            yield chunk
+
+    def query(self, chrom, start, end):
+        '''
+        Construct a BEDFile object given its own respective XML element,
+        referencing only those BED entries overlapping a region. Its BED file
+        is indexed once, see RegionIndex, and only overlapping lines are
+        subsequently read and parsed.
+        @param chrom: chromosome name.
+        @param start: 0-based start of the region.
+        @param end: end of the region.
+        @return: object of type BEDFile.
+        '''
+        bf = self.describe()
+        with metrics.stage('query', file=bf.get_file()) as record:
+            index = RegionIndex.open(bf.get_file())
+            bf.set_data(index.query(chrom, start, end, bf.is_scalar()))
+            record['rows'] = bf.get_data().shape[0]
+        label(bf)
         return bf
 
     def element(self):
         return self._element
 
+    @staticmethod
+    def build_all(elems, workers=None, cache=None):
+        '''
+        Construct BEDFile objects given many XML elements; each is built in
+        its own worker process.
+        @param elems: list of XML elements, i.e. from parse_config.
+        @param workers: number of worker processes; default is #CPUs.
+        @param cache: ParseCache object; parsed BED contents are re-used.
+        @return: list of BEDFile objects, ordered as per elems.
+        '''
+        if workers == 1 or len(elems) < 2:  # not worth forking
+            return [build(elem, cache) for elem in elems]
+        with ProcessPoolExecutor(workers) as pool:
+            packed = list(pool.map(pack, elems, [cache] * len(elems)))
+        return [build(elem, cache) if p is None else unpack(elem, p)
+                for elem, p in zip(elems, packed)]  # cached, or rebuilt
+
+    @staticmethod
+    def stream_all(elems, chunksize):
+        '''
+        Construct BEDFile objects given many XML elements, each referencing
+        a chunk of BED lines; see stream.
+        @param elems: list of XML elements, i.e. from parse_config.
+        @param chunksize: number of BED lines per BEDFile object.
+        @return: generator of BEDFile objects, ordered as per elems.
+        '''
+        for elem in elems:
+            yield from BEDFileFactory(elem).stream(chunksize)
+
+    @staticmethod
+    def query_all(elems, chrom, start, end):
+        '''
+        Construct BEDFile objects given many XML elements, each referencing
+        only those BED entries overlapping a region; see query.
+        @param elems: list of XML elements, i.e. from parse_config.
+        @param chrom: chromosome name.
+        @param start: 0-based start of the region.
+        @param end: end of the region.
+        @return: list of BEDFile objects, ordered as per elems.
+        '''
+        return [BEDFileFactory(elem).query(chrom, start, end)
+                for elem in elems]
+
     @staticmethod
     def combine(x):
-        return concat([i.get_data() for i in x], ignore_index=True)
+        '''
+        Concatenate the contents of many BEDFile objects. Categorical columns
+        are first given identical categories so they remain categorical.
+        @param x: list of BEDFile objects.
+        @return: data-frame of all BED contents.
+        '''
+        frames = [i.get_data() for i in x]
+        for col in CATEGORICAL:
+            if not frames or not all(col in f.columns and
+                                     f[col].dtype.name == 'category'
+                                     for f in frames):
+                continue
+            cats = reduce(Index.union, [f[col].cat.categories for f in frames])
+            frames = [f.assign(**{col: f[col].cat.set_categories(cats)})
+                      for f in frames]
+        return concat(frames, ignore_index=True)
+
+
+def build(elem, cache=None):
+    '''
+    Construct a BEDFile object given its XML element; used by worker
+    processes as it can be pickled, unlike bound methods of BEDFileFactory.
+    @param elem: XML element.
+    @param cache: ParseCache object; parsed BED contents are re-used.
+    @return: object of type BEDFile.
+    '''
+    return BEDFileFactory(elem).build(cache)
+
+
+def pack(elem, cache=None):
+    '''
+    Parse the BED contents of an XML element within a worker process. Given
+    a cache, contents are only cached so that the parent memory-maps them.
+    Otherwise, vectors are returned as a single buffer rather than pickled
+    as an array per entry; see unpack.
+    @param elem: XML element.
+    @param cache: ParseCache object; parsed BED contents are re-used.
+    @return: tuple of vector buffer, its offsets, and all other columns; None
+    given a cache.
+    '''
+    if cache is not None:
+        bf = BEDFileFactory(elem).describe()
+        parse = ioutils.parse_abstract_bed if bf.is_scalar() else\
+            ioutils.parse_vectorized_bed
+        with metrics.stage('build', file=bf.get_file()) as record:
+            record['rows'] = cache.fetch(bf.get_file(), bf.is_scalar(),
+                                         parse).shape[0]
+        return None
+    df = BEDFileFactory(elem).build().get_data()
+    if 'Vectors' not in df.columns:
+        return None, None, df
+    buf, offsets = ioutils.vector_buffer(df['Vectors'])
+    return buf, offsets, df.assign(Vectors=None)
+
+
+def unpack(elem, packed):
+    '''
+    Construct a BEDFile object given contents parsed by a worker process;
+    each Vectors entry is once again a view into a single buffer.
+    @param elem: XML element.
+    @param packed: tuple of vector buffer, its offsets, and all other
+    columns; see pack.
+    @return: object of type BEDFile.
+    '''
+    buf, offsets, df = packed
+    if buf is not None:
+        df['Vectors'] = [buf[i:j] for i, j in zip(offsets[:-1], offsets[1:])]
+    bf = BEDFileFactory(elem).describe()
+    bf.set_data(df)
+    return bf
+
+
+def label(bf):
+    '''
+    Adds the tissue and class of a BEDFile object to each of its entries;
+    both are categorical as they are identical across all entries.
+    @param bf: BEDFile object.
+    '''
+    n = bf.get_data().shape[0]
+    for col, value in [('Tissue', bf.get_tissue()), ('Class', bf.get_class())]:
+        bf.get_data()[col] = Categorical.from_codes(np.zeros(n, np.int8),
+                                                    categories=[value])
 
 
 class BEDFile():
@@ -57,6 +243,9 @@ class BEDFile():
     degree of tissue-specificity. Accompanying BigWig files may also be
     present for the BED file; in-cases whereby assays were performed.
     '''
+    __slots__ = ('_bedfile', '_fasta', '_data', '_tissue_name',
+                 '_tissue_class', '_bigwigs', '_is_scalar')
+
     def __init__(self):
         self._bedfile = None  # input filename
         self._fasta = None  # corresponding FASTA sequences
@@ -0,0 +1,328 @@
+'''
+Enables region-of-interest queries of BED files without parsing them in their
+entirety. A per-chromosome index of entries, sorted by start, records where
+each entry is found within its BED file; plain-text or bgzip-compressed. A
+query then seeks straight to overlapping entries, parsing only these.
+'''
+
+import argparse
+import json
+import os
+import re
+import struct
+import zlib
+from io import BytesIO
+import numpy as np
+from pandas import DataFrame, read_table
+from src import metrics
+from src.ioutils import BED_DTYPES, abstract_bed, vectorize_bed
+
+REGION_SUFFIX = '.rdx'  # folder suffix of saved RegionIndex objects
+CHUNK_BYTES = 1 << 26  # uncompressed bytes indexed at a time
+BGZIP_MAGIC = b'\x1f\x8b\x08\x04'  # gzip, with extra fields
+GZIP_MAGIC = b'\x1f\x8b'
+
+
+def parse_region(region):
+    '''
+    @param region: chromosome, optionally followed by :start-end; 1-based
+    and inclusive, as per samtools, i.e. chr7:27,000,001-27,300,000.
+    @return: tuple of chromosome, 0-based start, and end.
+    '''
+
+    found = re.match(r'^([^:]+)(?::([\d,]+)-([\d,]+))?$', region.strip())
+    if not found:
+        raise IOError('Malformed region: ' + region)
+    if found.group(2) is None:  # the entire chromosome
+        return found.group(1), 0, np.iinfo(np.int64).max
+    start, end = [int(i.replace(',', '')) for i in found.group(2, 3)]
+    if start < 1 or end < start:
+        raise IOError('Malformed region: ' + region)
+    return found.group(1), start - 1, end
+
+
+def is_bgzip(f):
+    '''
+    @param f: BED filename.
+    @return: whether f is bgzip-compressed; other gzip files cannot be
+    sought within, and are rejected.
+    '''
+
+    with open(f, 'rb') as handle:
+        header = handle.read(16)
+    if header[:4] == BGZIP_MAGIC and header[12:14] == b'BC':
+        return True
+    if header[:2] == GZIP_MAGIC:
+        raise IOError(f + ' is gzip, not bgzip-compressed; recompress it '
+                      'with bgzip to query regions.')
+    return False
+
+
+def read_block(handle, coffset):
+    '''
+    Decompresses a single bgzip block.
+    @param handle: binary file handle of a bgzip-compressed file.
+    @param coffset: compressed offset of the block.
+    @return: tuple of uncompressed data and the offset of the next block;
+    None given the end of the file.
+    '''
+
+    handle.seek(coffset)
+    header = handle.read(18)
+    if len(header) < 18:
+        return None
+    if header[:4] != BGZIP_MAGIC or header[12:14] != b'BC':
+        raise IOError(handle.name + ' is not bgzip-compressed.')
+    size = struct.unpack('<H', header[16:18])[0] + 1  # total block size
+    data = handle.read(size - 18)
+    return zlib.decompress(data[:-8], -15), coffset + size  # raw deflate
+
+
+def iter_chunks(f, compressed):
+    '''
+    Reads a BED file in chunks of whole lines.
+    @param f: BED file; plain-text or bgzip-compressed.
+    @param compressed: whether f is bgzip-compressed.
+    @return: generator of tuples; uncompressed data, its uncompressed offset,
+    and given bgzip, the compressed and uncompressed offset of each block.
+    '''
+
+    with open(f, 'rb') as handle:
+        pending, pos, coffset, blocks = b'', 0, 0, []
+        while True:
+            parts = [pending]
+            size = len(pending)
+            while size < CHUNK_BYTES:
+                if compressed:
+                    block = read_block(handle, coffset)
+                    if block is None:
+                        break
+                    blocks.append((coffset, pos + size))
+                    data, coffset = block
+                else:
+                    data = handle.read(CHUNK_BYTES)
+                parts.append(data)
+                size += len(data)
+                if not data:
+                    break
+            data = b''.join(parts)
+            if not data:
+                return
+            last = data.rfind(b'\n') + 1
+            if last == 0 or size < CHUNK_BYTES:  # the very last chunk
+                last = len(data)
+            yield data[:last], pos, blocks
+            pending, pos = data[last:], pos + last
+            if blocks:  # retain the block holding the start of pending
+                first = np.searchsorted([u for _, u in blocks], pos, 'right')
+                blocks = blocks[max(first - 1, 0):]
+
+
+class RegionIndex():
+    '''
+    Per-chromosome index of BED entries sorted by start. Each entry
+    references the offset of its line; a virtual offset, as per tabix, given
+    bgzip-compressed BED files. Entries overlapping a region are found by
+    binary search, bounded by the longest entry of each chromosome.
+    '''
+    def __init__(self, bed, compressed=False):
+        self._bed = bed
+        self._compressed = compressed
+        self._chroms = {}  # chromosome => starts, ends, and line offsets
+        self._longest = {}  # chromosome => length of its longest entry
+
+    @staticmethod
+    def build(bed):
+        '''
+        Construct a RegionIndex given a BED file; only chromosome, start,
+        and end columns are parsed, a chunk of lines at a time.
+        @param bed: BED file; plain-text or bgzip-compressed.
+        @return: object of type RegionIndex.
+        '''
+        index = RegionIndex(bed, is_bgzip(bed))
+        cols = {'Chr': [], 'Start': [], 'End': [], 'Offset': []}
+        with metrics.stage('region_index', file=bed) as record:
+            for data, pos, blocks in iter_chunks(bed, index._compressed):
+                raw = np.frombuffer(data, dtype=np.uint8)
+                lines = np.concatenate(([0], np.flatnonzero(raw == 10) + 1))
+                lines = lines[lines < len(data)]  # start of each line
+                df = read_table(BytesIO(data), header=None, sep='\t',
+                                usecols=[0, 1, 2], dtype={0: str},
+                                skip_blank_lines=False)
+                keep = df[1].notna().values  # blank lines are skipped
+                offsets = pos + lines[keep]
+                if index._compressed:  # block offset << 16 | within block
+                    cstarts = np.array([c for c, _ in blocks], np.int64)
+                    ustarts = np.array([u for _, u in blocks], np.int64)
+                    blk = np.searchsorted(ustarts, offsets, 'right') - 1
+                    offsets = (cstarts[blk] << 16) | (offsets - ustarts[blk])
+                cols['Chr'].append(df[0].values[keep])
+                cols['Start'].append(df[1].values[keep].astype(np.int64))
+                cols['End'].append(df[2].values[keep].astype(np.int64))
+                cols['Offset'].append(offsets.astype(np.int64))
+            df = DataFrame({k: np.concatenate(v) if v else np.empty(0)
+                            for k, v in cols.items()})
+            record['rows'] = df.shape[0]
+            for chrom, rows in df.groupby('Chr', sort=False).indices.items():
+                starts = df['Start'].values[rows]
+                by_start = np.lexsort((df['Offset'].values[rows], starts))
+                index.attach(chrom, starts[by_start],
+                             df['End'].values[rows][by_start],
+                             df['Offset'].values[rows][by_start])
+        return index
+
+    @staticmethod
+    def load(folder, bed):
+        '''
+        Construct a RegionIndex given a folder whereby it was saved. All
+        arrays are memory-mapped rather than read.
+        @param folder: saved RegionIndex folder.
+        @param bed: BED file the index references.
+        @return: object of type RegionIndex, or None if the index is stale.
+        '''
+        try:
+            with open(os.path.join(folder, 'meta.json')) as handle:
+                meta = json.load(handle)
+        except (IOError, ValueError):
+            return None
+        if meta['stat'] != list(file_stat(bed)):
+            return None  # BED file has since been modified
+        index = RegionIndex(bed, meta['compressed'])
+        arrays = [np.load(os.path.join(folder, name + '.npy'), 'r')
+                  for name in ['starts', 'ends', 'offsets']]
+        bounds = meta['bounds']
+        for num, chrom in enumerate(meta['chroms']):
+            lo, hi = bounds[num], bounds[num + 1]
+            index.attach(chrom, *[arr[lo:hi] for arr in arrays])
+        return index
+
+    @staticmethod
+    def open(bed):
+        '''
+        Load the saved index of a BED file, building and saving it if
+        need-be, i.e. as per index_fasta.
+        @param bed: BED file; plain-text or bgzip-compressed.
+        @return: object of type RegionIndex.
+        '''
+        index = RegionIndex.load(bed + REGION_SUFFIX, bed)
+        if index is None:
+            index = RegionIndex.build(bed)
+            try:
+                index.save(bed + REGION_SUFFIX)
+            except IOError:
+                pass  # BED folder is read-only; index is simply not re-used
+        return index
+
+    def save(self, folder):
+        '''
+        Save this RegionIndex to a folder of memory-mappable arrays.
+        @param folder: folder to save the index; should end with .rdx
+        '''
+        os.makedirs(folder, exist_ok=True)
+        chroms = list(self._chroms.keys())
+        for num, name in enumerate(['starts', 'ends', 'offsets']):
+            arrays = [self._chroms[c][num] for c in chroms]
+            np.save(os.path.join(folder, name + '.npy'),
+                    np.concatenate(arrays) if arrays else
+                    np.empty(0, dtype=np.int64))
+        bounds = np.cumsum([0] + [len(self._chroms[c][0]) for c in chroms])
+        with open(os.path.join(folder, 'meta.json'), 'w') as handle:
+            json.dump({'chroms': chroms, 'bounds': bounds.tolist(),
+                       'compressed': self._compressed,
+                       'stat': list(file_stat(self._bed))}, handle)
+
+    def attach(self, chrom, starts, ends, offsets):
+        '''
+        Index entries of a single chromosome given arrays sorted by start.
+        @param chrom: chromosome name.
+        @param starts: 0-based start indices.
+        @param ends: end indices.
+        @param offsets: offset of each entry line.
+        '''
+        self._chroms[str(chrom)] = (starts, ends, offsets)
+        self._longest[str(chrom)] = int((ends - starts).max()) if\
+            len(starts) > 0 else 0
+
+    def chromosomes(self):
+        return list(self._chroms.keys())
+
+    def lookup(self, chrom, start, end):
+        '''
+        @param chrom: chromosome name.
+        @param start: 0-based start of the region.
+        @param end: end of the region.
+        @return: sorted numpy array; line offsets of entries overlapping
+        the region, i.e. in the order they occur in the BED file.
+        '''
+        if chrom not in self._chroms:
+            return np.empty(0, dtype=np.int64)
+        starts, ends, offsets = self._chroms[chrom]
+        lo = np.searchsorted(starts, max(start - self._longest[chrom], 0),
+                             'left')  # no entry starting before overlaps
+        hi = np.searchsorted(starts, end, 'left')
+        found = np.asarray(offsets[lo:hi])[np.asarray(ends[lo:hi]) > start]
+        return np.sort(found)
+
+    def read_lines(self, offsets):
+        '''
+        @param offsets: numpy array of line offsets, in ascending order.
+        @return: bytes of each line referenced, joined; each block of a
+        bgzip-compressed file is decompressed at-most once.
+        '''
+        lines = []
+        with open(self._bed, 'rb') as handle:
+            if not self._compressed:
+                for offset in offsets:
+                    handle.seek(offset)
+                    lines.append(handle.readline())
+                return b''.join(lines)
+            blocks = {}  # compressed offset => data, next block offset
+            for offset in offsets:
+                coffset = int(offset) >> 16  # block, and position within
+                pos = int(offset) & 0xFFFF
+                line = b''
+                while coffset is not None:  # lines may span many blocks
+                    if coffset not in blocks:
+                        blocks[coffset] = read_block(handle, coffset) or\
+                            (b'', None)
+                    data, after = blocks[coffset]
+                    stop = data.find(b'\n', pos)
+                    if stop >= 0:
+                        line += data[pos:stop + 1]
+                        break
+                    line, coffset, pos = line + data[pos:], after, 0
+                lines.append(line if line.endswith(b'\n') else line + b'\n')
+        return b''.join(lines)
+
+    def query(self, chrom, start, end, is_scalar=True):
+        '''
+        Parse only those BED entries overlapping a region.
+        @param chrom: chromosome name.
+        @param start: 0-based start of the region.
+        @param end: end of the region.
+        @param is_scalar: whether the BED file is scalar; otherwise, only
+        the vectors of overlapping entries are decoded.
+        @return: data-frame of BED contents, parsed as per BEDFileFactory.
+        '''
+        offsets = self.lookup(chrom, start, end)
+        if len(offsets) == 0:
+            return DataFrame(columns=['Chr', 'Start', 'End', 'Length'] +
+                             ([] if is_scalar else ['Vectors',
+                                                    'Vector_Length']))
+        df = read_table(BytesIO(self.read_lines(offsets)), header=None,
+                        sep='\t', dtype=BED_DTYPES)
+        df = abstract_bed(df)
+        return df if is_scalar else vectorize_bed(df)
+
+
+def file_stat(f):
+    return os.path.getsize(f), os.stat(f).st_mtime_ns
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-bed', metavar='FILE', required=True, nargs='+',
+                        help='BED files; plain-text or bgzip [req]')
+    args = vars(parser.parse_args())
+    for bed in args['bed']:  # saved alongside each BED file
+        RegionIndex.build(bed).save(bed + REGION_SUFFIX)
@@ -0,0 +1,118 @@
+'''
+Generates synthetic, yet deterministic, input files; namely BED files,
+vectorized BED files, GTF annotations, and configuration files. Such files
+enable benchmarking without access to any real datasets.
+'''
+
+import numpy as np
+from xml.etree import ElementTree
+from pandas import DataFrame
+from src.config import to_element
+
+CHROM_LENGTH = int(5e7)  # bases per synthetic chromosome
+CHUNK_ENTRIES = 10000  # vectorized entries formatted at a time
+
+
+def random_intervals(rng, n, lengths, chroms=4):
+    '''
+    Selects random intervals across synthetic chromosomes.
+    @param rng: numpy random Generator.
+    @param n: number of intervals.
+    @param lengths: collection of interval lengths to select from.
+    @param chroms: number of synthetic chromosomes.
+    @return: data-frame of chromosome, start, and end; sorted by position.
+    '''
+
+    le = rng.choice(np.asarray(lengths), size=n)
+    df = DataFrame({'Chr': rng.integers(1, chroms + 1, size=n),
+                    'Start': rng.integers(0, CHROM_LENGTH - le.max(), size=n)})
+    df['End'] = df['Start'] + le
+    df = df.sort_values(['Chr', 'Start'], kind='mergesort')
+    df['Chr'] = 'chr' + df['Chr'].astype(str)
+    return df.reset_index(drop=True)
+
+
+def write_bed(fname, n, seed=0, lengths=(100, 200, 300)):
+    '''
+    Writes a scalar BED file.
+    @param fname: BED filename.
+    @param n: number of BED entries.
+    @param seed: random seed.
+    @param lengths: collection of entry lengths to select from.
+    @return: BED filename.
+    '''
+
+    df = random_intervals(np.random.default_rng(seed), n, lengths)
+    df.to_csv(fname, sep='\t', header=False, index=False)
+    return fname
+
+
+def write_vectorized_bed(fname, n, seed=0, lengths=(100, 200)):
+    '''
+    Writes a vectorized BED file; each entry has a vector of per-base scores.
+    @param fname: BED filename.
+    @param n: number of BED entries.
+    @param seed: random seed.
+    @param lengths: collection of entry lengths to select from.
+    @return: BED filename.
+    '''
+
+    rng = np.random.default_rng(seed)
+    df = random_intervals(rng, n, lengths)
+    with open(fname, 'w') as out:  # scores are drawn a chunk at a time
+        for i in range(0, n, CHUNK_ENTRIES):
+            chunk = df.iloc[i:i + CHUNK_ENTRIES]
+            le = (chunk['End'] - chunk['Start']).values
+            scores = np.round(rng.random(int(le.sum())), 3).tolist()
+            offsets = np.concatenate(([0], np.cumsum(le))).tolist()
+            for (chrom, start, end), j, k in zip(chunk.values, offsets[:-1],
+                                                 offsets[1:]):
+                out.write('\t'.join([chrom, str(start), str(end),
+                                     ','.join(map(str, scores[j:k]))]) +
+                          '\n')
+    return fname
+
+
+def write_gtf(fname, n, seed=0):
+    '''
+    Writes a GTF file of gene annotations, each with a gene_id attribute.
+    @param fname: GTF filename.
+    @param n: number of GTF entries.
+    @param seed: random seed.
+    @return: GTF filename.
+    '''
+
+    rng = np.random.default_rng(seed)
+    df = random_intervals(rng, n, lengths=range(1000, 50000, 1000))
+    with open(fname, 'w') as out:
+        for num, (chrom, start, end) in enumerate(df.values):
+            out.write('\t'.join([chrom, 'synthetic', 'gene', str(start + 1),
+                                 str(end), '.', '+', '.',
+                                 'gene_id "G' + str(num) + '";']) + '\n')
+    return fname
+
+
+def write_config(fname, beds, scalar=False, bigwigs=()):
+    '''
+    Writes a configuration file, structured as per config.generate.
+    @param fname: XML filename.
+    @param beds: list of tuples; BED filename, class, and tissue.
+    @param scalar: whether the BED files are scalar.
+    @param bigwigs: BigWig filenames shared by all BED files.
+    @return: XML filename.
+    '''
+
+    root = ElementTree.Element('configuration')
+    bedfiles = ElementTree.SubElement(root, 'bedfiles')
+    for bed, cls, tissue in beds:
+        bed_elem = to_element(parent=bedfiles, tag='bed')
+        to_element(parent=bed_elem, tag='file', text=bed)
+        to_element(parent=bed_elem, tag='class', text=cls)
+        to_element(parent=bed_elem, tag='tissue', text=tissue)
+        to_element(parent=bed_elem, tag='fasta', text=' ')
+        bwfiles = to_element(parent=bed_elem, tag='bigwigfiles')
+        for bw in bigwigs:
+            to_element(parent=bwfiles, tag='bw', text=bw)
+        to_element(parent=bed_elem, tag='is_scalar', text=str(scalar))
+    ElementTree.ElementTree(root).write(fname)
+    return fname
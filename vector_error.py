@@ -8,28 +8,153 @@ element x maps to integer x; for easy plotting on the x-y coordinate plane.
 import argparse
 import numpy
 import scipy.stats
-import sys
-from itertools import product
+import zlib
 from pandas import DataFrame, concat
-from src.ioutils import parse_config
+from src.ioutils import FORMATS, parse_arguments, parse_config, write_results
 from src.model import BEDFileFactory
+from src.cache import open_cache
+from src.incremental import (element_fingerprint, group_elements,
+                             group_key, open_store)
+from src import metrics
 
+COLUMNS = ['Tissue', 'Class', 'Length', 'Index', 'Mu', 'Upr', 'Lwr']
+METHODS = ['percentile', 'normal', 'bootstrap']
+CHUNK_BYTES = 64 * 1024 ** 2  # bound on resampled indices held in memory
 
-def confidence_interval(x, ci=0.95):
+
+def confidence_interval(x, ci=0.95, method='percentile', rng=None,
+                        resamples=1000):
     '''
-    Computes a confidence interval given a numerical vector.
-    @param x: numerical vector.
+    Computes a confidence interval given a numerical vector. If a matrix is
+    provided, an interval is computed for each of its columns.
+    @param x: numerical vector or matrix.
     @param ci: Confidence interval; default = 0.95
+    @param method: percentile, bounding the values themselves; otherwise
+    normal or bootstrap, bounding their mean.
+    @param rng: numpy random Generator, given bootstrap.
+    @param resamples: number of bootstrap resamples.
     @return: tuple given mean, upper, and lower bounds given the vector.
     '''
 
     low_per = 100 * (1 - ci) / 2.
     high_per = 100 * ci + low_per
-    mu = x.mean()
-    lwr, upr = scipy.stats.scoreatpercentile(x, [low_per, high_per])
+    mu = x.mean(axis=0, dtype=numpy.float64)
+    if method == 'normal':  # standard error of the mean
+        err = scipy.stats.norm.ppf(0.5 + ci / 2.) * numpy.std(
+            x, axis=0, ddof=1, dtype=numpy.float64) / numpy.sqrt(len(x))
+        return mu, mu + err, mu - err
+    if method == 'bootstrap':
+        x = bootstrap_means(x, rng or numpy.random.default_rng(), resamples)
+    elif method != 'percentile':
+        raise ValueError('Unknown confidence interval method: ' + method)
+    lwr, upr = scipy.stats.scoreatpercentile(x, [low_per, high_per], axis=0)
     return mu, upr, lwr  # return the mean and its respective bounds.
 
 
+def bootstrap_means(x, rng, resamples=1000):
+    '''
+    Derives bootstrap means of a numerical vector, or of each column of a
+    matrix. Row indices are drawn once per resample and shared by every
+    column; each chunk of resamples is tallied into a matrix of row counts,
+    whose product with x yields all means at once.
+    @param x: numerical vector or matrix.
+    @param rng: numpy random Generator.
+    @param resamples: number of bootstrap resamples.
+    @return: numpy array of means; one row per resample.
+    '''
+
+    n = len(x)
+    step = max(CHUNK_BYTES // (8 * n), 1)  # resamples per chunk
+    means = numpy.empty((resamples,) + x.shape[1:])
+    for i in range(0, resamples, step):
+        size = min(step, resamples - i)
+        idx = rng.integers(0, n, size=(size, n)) +\
+            n * numpy.arange(size)[:, None]  # unique per resample
+        counts = numpy.bincount(idx.ravel(), minlength=size * n)
+        means[i:i + size] = counts.reshape(size, n) @ x / n
+    return means
+
+
+def group_rng(seed, t, le, c):
+    '''
+    @return: numpy random Generator unique to a seed, tissue, length, and
+    class; draws are therefore independent of any other groups.
+    '''
+
+    group = zlib.crc32(repr((str(t), int(le), str(c))).encode('utf-8'))
+    return numpy.random.default_rng([seed, group])
+
+
+def interval_table(df, ci=0.95, method='percentile', resamples=1000, seed=0):
+    '''
+    Computes the mean and confidence interval of each vector position given
+    every tissue, length, and class.
+    @param df: data-frame of vectorized BED entries.
+    @param ci: Confidence interval; default = 0.95
+    @param method: percentile, normal, or bootstrap; see confidence_interval.
+    @param resamples: number of bootstrap resamples.
+    @param seed: random seed, given bootstrap.
+    @return: data-frame with one row per tissue, class, length, and index.
+    '''
+
+    with metrics.stage('ci', rows=df.shape[0], method=method):
+        return _interval_table(df, ci, method, resamples, seed)
+
+
+def _interval_table(df, ci, method, resamples, seed):
+    data = []
+    groups = df.groupby(['Tissue', 'Length', 'Class'], sort=True,
+                        observed=True)
+    for (t, le, c), grp in groups:  # only tissue, length, class present
+        mat = numpy.vstack(grp['Vectors'].tolist())  # entries x bases
+        mu, upr, lwr = confidence_interval(mat, ci, method,
+                                           group_rng(seed, t, le, c),
+                                           resamples)
+        data.append(DataFrame({'Tissue': t, 'Class': c, 'Length': le,
+                               'Index': numpy.arange(1, mat.shape[1] + 1),
+                               'Mu': mu, 'Upr': upr, 'Lwr': lwr},
+                              columns=COLUMNS))
+    return concat(data, ignore_index=True) if data else\
+        DataFrame(columns=COLUMNS)
+
+
+def incremental_table(elems, store, ci=0.95, jobs=None, cache=None,
+                      method='percentile', resamples=1000, seed=0):
+    '''
+    Computes the confidence intervals of each tissue and class, see
+    interval_table, re-using those of groups whose BED files are unchanged.
+    @param elems: list of XML elements, i.e. from parse_config.
+    @param store: ResultStore object; per-group results are persisted.
+    @param ci: Confidence interval; default = 0.95
+    @param jobs: number of worker processes for loading BEDs.
+    @param cache: ParseCache object; parsed BED contents are re-used.
+    @param method: percentile, normal, or bootstrap; see confidence_interval.
+    @param resamples: number of bootstrap resamples.
+    @param seed: random seed, given bootstrap.
+    @return: data-frame with one row per tissue, class, length, and index.
+    '''
+
+    data = []
+    params = (ci, method, resamples, seed) if method == 'bootstrap' else\
+        (ci, method)
+    groups = group_elements(elems, lambda bf: (bf.get_tissue(),
+                                               bf.get_class()))
+    for group, members in groups.items():  # lengths are per tissue, class
+        members = [elems[i] for i in members]
+        key = group_key('ci', params,
+                        [element_fingerprint(i) for i in members])
+        data += store.recall([key], lambda: [interval_table(
+            BEDFileFactory.combine(BEDFileFactory.build_all(members, jobs,
+                                                            cache)),
+            ci, method, resamples, seed)], group)
+    data = [df for df in data if df.shape[0] > 0]
+    if not data:
+        return DataFrame(columns=COLUMNS)
+    df = concat(data, ignore_index=True)  # ordered as per interval_table
+    return df.sort_values(['Tissue', 'Length', 'Class'], kind='mergesort',
+                          ignore_index=True)
+
+
 def main(args):
     '''
     BED vectors are essentially an i x j matrix, whereby you have i enhancers,
@@ -39,28 +164,70 @@ def main(args):
     @param args: dictionary of command-line arguments.
     '''
 
-    df = concat([BEDFileFactory(e).build().get_data()
-                 for e in parse_config(args['in'])])
-    combs = product(*[set(df['Tissue']), set(df['Length']), set(df['Class'])])
-    data = DataFrame()
-    for t, le, c in list(combs):  # loop combinations of tissue, length, class
-        mat = numpy.matrix(df[(df['Length'] == le) & (df['Tissue'] == t) &
-                           (df['Class'] == c)]['Vectors'].tolist())
-        for num in range(mat.shape[1]):  # iterate over columns, get interval
-            mu, upr, lwr = confidence_interval(mat[:, num], args['conf'])
-            data = data.append({'Tissue': t, 'Class': c, 'Length': le,
-                                'Index': num + 1, 'Mu': mu, 'Upr': upr,
-                                'Lwr': lwr}, ignore_index=True)
-    data.to_csv(sys.stdout, index=False)
+    metrics.configure(args['metrics'], args['profile'])
+    cache = open_cache(args['cache'])
+    store = open_store(args['incremental'])
+    if store is not None:  # only changed tissues and classes are computed
+        df = incremental_table(parse_config(args['in']), store, args['conf'],
+                               args['jobs'], cache, args['method'],
+                               args['resamples'], args['seed'])
+        write_results(df, args['out'], args['format'])
+        return
+    run(args, BEDFileFactory.build_all(parse_config(args['in']),
+                                       args['jobs'], cache))
+
+
+def run(args, beds, df=None):
+    '''
+    Sends the confidence intervals of all BED vectors to standard-output.
+    @param args: dictionary of command-line arguments.
+    @param beds: list of BEDFile objects; already built.
+    @param df: data-frame of all BED contents; combined from beds if None.
+    '''
+
+    df = BEDFileFactory.combine(beds) if df is None else df
+    write_results(interval_table(df, args['conf'], args['method'],
+                                 args['resamples'], args['seed']),
+                  args['out'], args['format'])
+
+
+def arguments(parser):
+    '''
+    Adds the command-line arguments of this script.
+    @param parser: argparse.ArgumentParser object.
+    @return: the same parser.
+    '''
+
+    parser.add_argument('-in', metavar='XML', required=True,
+                        help='XML configuration file [req]')
+    parser.add_argument('-cache', metavar='DIR', default=None,
+                        help='Cache parsed BED files in folder [None]')
+    parser.add_argument('-jobs', metavar='INT', default=None, type=int,
+                        help='Worker processes for loading BEDs [#CPUs]')
+    parser.add_argument('-incremental', metavar='DIR', default=None,
+                        help='Re-use per-group results in folder [None]')
+    parser.add_argument('-conf', metavar='FLOAT', default=0.95,
+                        type=float, help='Confidence interval [0.95]')
+    parser.add_argument('-method', default='percentile', choices=METHODS,
+                        help='Confidence interval method [percentile]')
+    parser.add_argument('-resamples', metavar='INT', default=1000,
+                        type=int, help='Bootstrap resamples [1000]')
+    parser.add_argument('-seed', metavar='INT', default=0, type=int,
+                        help='Seed for bootstrap resamples [0]')
+    parser.add_argument('-out', metavar='FILE', default=None,
+                        help='Results filename [stdout]')
+    parser.add_argument('-format', default='csv', choices=FORMATS,
+                        help='Results format; all but csv need -out [csv]')
+    parser.add_argument('-metrics', metavar='FILE', default=None,
+                        help='Append per-stage metrics to FILE [None]')
+    parser.add_argument('-profile', metavar='DIR', default=None,
+                        help='Save per-stage cProfile dumps to DIR [None]')
+    return parser
+
 
 if __name__ == '__main__':
     try:
-        parser = argparse.ArgumentParser()
-        parser.add_argument('-in', metavar='XML', required=True,
-                            help='XML configuration file [req]')
-        parser.add_argument('-conf', metavar='FLOAT', default=0.95,
-                            type=float, help='Confidence interval [0.95]')
-        args = vars(parser.parse_args())  # parse arguments
+        args = parse_arguments(arguments(argparse.ArgumentParser()))
         main(args)
     except KeyboardInterrupt:
         print()
@@ -6,24 +6,52 @@ lengths are statistically significant.
 
 import argparse
 import numpy
-import sys
-from itertools import product, chain
-from src.ioutils import parse_config
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from itertools import product
+from src.ioutils import FORMATS, parse_arguments, parse_config, write_results
 from src.model import BEDFileFactory
+from src.cache import open_cache
+from src.incremental import (element_fingerprint, group_elements,
+                             group_key, open_store)
+from src import metrics
 from src.config import TISSUE_SPEC, UBIQUITOUS
-from pandas import concat, DataFrame
-from scipy.stats import ranksums
+from pandas import DataFrame, concat, unique
+from scipy.stats import norm
 
+SUMMARIES = ['mean', 'max', 'window']  # per-entry reductions of vectors
+CHUNK_ENTRIES = 4096  # vectors stacked at a time given a summary
 
-def wilcox_test(x, y):
+
+def ranksums_sorted(x, y):
     '''
-    Performs the Wilcoxon-Ranked Sums Test.
-    @param x: collection of numerics.
-    @param y: collection of numerics.
-    @return: float referencing the test p-value.
+    Performs the Wilcoxon-Ranked Sums Test given samples that are already
+    sorted. The rank-sum of x is derived by merging x into y rather than
+    ranking the pooled sample, yet is identical to scipy.stats.ranksums.
+    @param x: sorted numpy array.
+    @param y: sorted numpy array.
+    @return: float referencing the test p-value; NaN if a sample is empty.
+    '''
+
+    n1, n2 = len(x), len(y)
+    if n1 == 0 or n2 == 0:
+        return numpy.nan
+    below = numpy.searchsorted(y, x, 'left').sum()  # y less than each x
+    tied = numpy.searchsorted(y, x, 'right').sum() - below  # y equal to x
+    s = n1 * (n1 + 1) / 2. + below + tied / 2.  # rank-sum of x
+    expected = n1 * (n1 + n2 + 1) / 2.
+    z = (s - expected) / numpy.sqrt(n1 * n2 * (n1 + n2 + 1) / 12.)
+    return 2 * norm.sf(abs(z))
+
+
+def clamp_pvalue(pval):
+    '''
+    Ensures a p-value is numeric and non-zero.
+    @param pval: float referencing a p-value.
+    @return: float referencing the clamped p-value.
     '''
 
-    pval = ranksums(x, y)[-1].astype('float64')
     if numpy.isnan(pval):  # replace NaN with a poor p-value.
         pval = 1.0
     if pval == 0.0:  # sanity checks to ensure all values are non-zero.
@@ -31,6 +59,227 @@ def wilcox_test(x, y):
     return pval
 
 
+def wilcox_test(x, y):
+    '''
+    Performs the Wilcoxon-Ranked Sums Test.
+    @param x: collection of numerics.
+    @param y: collection of numerics.
+    @return: float referencing the test p-value.
+    '''
+
+    return clamp_pvalue(ranksums_sorted(numpy.sort(x), numpy.sort(y)))
+
+
+def reduce_vectors(mat, summary, window=10):
+    '''
+    @param mat: matrix; one vector per row.
+    @param summary: mean, max, or window; the maximum mean of any window.
+    @param window: window length, given window; capped by the vector length.
+    @return: numpy array; one value per row.
+    '''
+
+    if summary == 'mean':
+        return mat.mean(axis=1, dtype=numpy.float64)
+    elif summary == 'max':
+        return mat.max(axis=1)
+    elif summary == 'window':
+        w = max(min(window, mat.shape[1]), 1)
+        sums = numpy.cumsum(mat, axis=1, dtype=numpy.float64)
+        sums = numpy.hstack([numpy.zeros((len(mat), 1)), sums])
+        return ((sums[:, w:] - sums[:, :-w]) / w).max(axis=1)
+    raise ValueError('Unknown summary: ' + summary)
+
+
+def summarize_vectors(vectors, summary, window=10):
+    '''
+    Reduces each vector to a single value. Vectors are stacked only a chunk
+    at a time, so memory is proportional to the number of entries rather
+    than the number of bases.
+    @param vectors: list of numpy arrays.
+    @param summary: mean, max, or window; see reduce_vectors.
+    @param window: window length, given window.
+    @return: numpy array; one value per vector.
+    '''
+
+    values = numpy.empty(len(vectors))
+    for i in range(0, len(vectors), CHUNK_ENTRIES):
+        chunk = vectors[i:i + CHUNK_ENTRIES]
+        if len(set(len(v) for v in chunk)) == 1:  # reduce all at once
+            values[i:i + len(chunk)] = reduce_vectors(numpy.vstack(chunk),
+                                                      summary, window)
+        else:  # vectors whose length differs from that of their entry
+            values[i:i + len(chunk)] = [reduce_vectors(
+                v[None, :], summary, window)[0] for v in chunk]
+    return values
+
+
+def pooled_samples(df, summary=None, window=10):
+    '''
+    Pools and sorts the vectors of every tissue, class, and length.
+    @param df: data-frame of vectorized BED entries.
+    @param summary: mean, max, or window; pools a single value per entry
+    rather than every base, see reduce_vectors.
+    @param window: window length, given window.
+    @return: dictionary; (tissue, class, length) => sorted numpy array.
+    '''
+
+    groups = df.groupby(['Tissue', 'Class', 'Length'], observed=True)
+    if summary:
+        return {key: numpy.sort(summarize_vectors(grp['Vectors'].tolist(),
+                                                  summary, window))
+                for key, grp in groups}
+    return {key: numpy.sort(numpy.concatenate(grp['Vectors'].tolist()))
+            for key, grp in groups}
+
+
+def rank_pairs(buf, offsets, pairs):
+    '''
+    Performs the Wilcoxon-Ranked Sums Test given pairs of pooled samples.
+    @param buf: numpy array of all samples, each sorted, back-to-back.
+    @param offsets: sample i is buf[offsets[i]:offsets[i + 1]].
+    @param pairs: n x 2 numpy array; indices of samples x and y.
+    @return: numpy array of n clamped p-values.
+    '''
+
+    pvals = numpy.empty(len(pairs))
+    for num, (i, j) in enumerate(pairs):
+        pvals[num] = clamp_pvalue(ranksums_sorted(
+            buf[offsets[i]:offsets[i + 1]], buf[offsets[j]:offsets[j + 1]]))
+    return pvals
+
+
+def rank_file(fname, offsets, pairs):
+    '''
+    Worker-process counterpart of rank_pairs; samples are memory-mapped from
+    a .npy file rather than pickled.
+    '''
+
+    return rank_pairs(numpy.load(fname, mmap_mode='r'), offsets, pairs)
+
+
+def parallel_ranksums(buf, offsets, pairs, jobs=None):
+    '''
+    Performs rank_pairs across worker processes. Samples are saved once, as
+    a .npy file memory-mapped by every worker, and pairs are partitioned.
+    @param buf: numpy array of all samples, each sorted, back-to-back.
+    @param offsets: sample i is buf[offsets[i]:offsets[i + 1]].
+    @param pairs: n x 2 numpy array; indices of samples x and y.
+    @param jobs: number of worker processes; default is #CPUs.
+    @return: numpy array of n clamped p-values, ordered as per pairs.
+    '''
+
+    workers = jobs or os.cpu_count() or 1
+    if workers == 1 or len(pairs) < 2:  # not worth forking
+        return rank_pairs(buf, offsets, pairs)
+    parts = numpy.array_split(pairs, min(4 * workers, len(pairs)))
+    with tempfile.TemporaryDirectory(prefix='bedframework-') as folder:
+        fname = os.path.join(folder, 'samples.npy')
+        numpy.save(fname, buf)
+        with ProcessPoolExecutor(workers) as pool:  # order is retained
+            pvals = list(pool.map(rank_file, [fname] * len(parts),
+                                  [offsets] * len(parts), parts))
+    return numpy.concatenate(pvals)
+
+
+def similarity_table(df, jobs=1, summary=None, window=10):
+    '''
+    Contrasts tissue-specific and ubiquitous vectors of every tissue given
+    each pair of lengths.
+    @param df: data-frame of vectorized BED entries.
+    @param jobs: number of worker processes for rank-sums; None is #CPUs.
+    @param summary: mean, max, or window; contrasts a single value per
+    entry rather than every base, see reduce_vectors.
+    @param window: window length, given window.
+    @return: data-frame with one p-value per tissue and pair of lengths.
+    '''
+
+    with metrics.stage('ranksum', rows=df.shape[0], jobs=jobs,
+                       summary=summary):
+        return _similarity_table(df, jobs, summary, window)
+
+
+def _similarity_table(df, jobs, summary, window):
+    samples = pooled_samples(df, summary, window)  # each is sorted once
+    keys = {key: num for num, key in enumerate(samples)}
+    lengths = [len(x) for x in samples.values()]
+    offsets = numpy.concatenate(([0], numpy.cumsum(lengths, dtype=int),
+                                 [sum(lengths)]))  # last sample is empty
+    buf = numpy.concatenate(list(samples.values())) if samples else\
+        numpy.empty(0)
+    del samples
+    combs = list(product(*[df['Tissue'].unique(),
+                           df['Length'].unique(), df['Length'].unique()]))
+    pairs = numpy.array([(keys.get((t, TISSUE_SPEC, l_ts), len(keys)),
+                          keys.get((t, UBIQUITOUS, l_ub), len(keys)))
+                         for t, l_ts, l_ub in combs], dtype=int)
+    pvals = parallel_ranksums(buf, offsets, pairs.reshape(-1, 2), jobs)
+    return DataFrame({'Tissue': [i[0] for i in combs], 'PValue': pvals,
+                      'Length_TS': [i[1] for i in combs],
+                      'Length_UB': [i[2] for i in combs]})
+
+
+def tissue_results(members, jobs=None, cache=None, summary=None, window=10):
+    '''
+    Contrasts the vectors of a single tissue; see similarity_table.
+    @param members: list of XML elements of the tissue.
+    @param jobs: number of worker processes for loading BEDs, rank-sums.
+    @param cache: ParseCache object; parsed BED contents are re-used.
+    @param summary: mean, max, or window; see reduce_vectors.
+    @param window: window length, given window.
+    @return: list of data-frames; p-values given each pair of lengths of the
+    tissue, and the lengths of each member in order of appearance.
+    '''
+
+    bfs = BEDFileFactory.build_all(members, jobs, cache)
+    lengths = [DataFrame({'Member': num,
+                          'Length': unique(bf.get_data()['Length'].values)})
+               for num, bf in enumerate(bfs)]
+    return [similarity_table(BEDFileFactory.combine(bfs), jobs, summary,
+                             window),
+            concat(lengths, ignore_index=True)]
+
+
+def incremental_table(elems, store, jobs=None, cache=None, summary=None,
+                      window=10):
+    '''
+    Contrasts tissue-specific and ubiquitous vectors, see similarity_table,
+    re-using the p-values of tissues whose BED files are unchanged. Lengths
+    absent from a tissue have a p-value of 1, as one sample is empty.
+    @param elems: list of XML elements, i.e. from parse_config.
+    @param store: ResultStore object; per-tissue results are persisted.
+    @param jobs: number of worker processes for loading BEDs, rank-sums.
+    @param cache: ParseCache object; parsed BED contents are re-used.
+    @param summary: mean, max, or window; see reduce_vectors.
+    @param window: window length, given window.
+    @return: data-frame with one p-value per tissue and pair of lengths.
+    '''
+
+    pvals, lengths = {}, [None] * len(elems)
+    groups = group_elements(elems, lambda bf: bf.get_tissue())
+    for tissue, members in groups.items():
+        prints = [element_fingerprint(elems[i]) for i in members]
+        key = group_key('ranksum', summary, window if summary == 'window'
+                        else None, prints)
+        table, le = store.recall(
+            [key, group_key('lengths', key)],
+            lambda: tissue_results([elems[i] for i in members], jobs, cache,
+                                   summary, window), tissue)
+        pvals.update(zip(zip(table['Tissue'], table['Length_TS'],
+                             table['Length_UB']), table['PValue']))
+        for num, pos in enumerate(members):
+            lengths[pos] = le['Length'].values[le['Member'].values == num]
+    first = {t: min([i for i in members if len(lengths[i]) > 0],
+                    default=None) for t, members in groups.items()}
+    tissues = sorted([t for t in first if first[t] is not None],
+                     key=first.get)  # as per df['Tissue'].unique()
+    le = unique(numpy.concatenate(lengths)) if lengths else []
+    combs = list(product(tissues, le, le))  # as per df['Length'].unique()
+    return DataFrame({'Tissue': [i[0] for i in combs],
+                      'PValue': [pvals.get(i, 1.0) for i in combs],
+                      'Length_TS': [i[1] for i in combs],
+                      'Length_UB': [i[2] for i in combs]})
+
+
 def main(args):
     '''
     Given a list of BEDFile objects, compute their length distribution. Such
@@ -38,27 +287,66 @@ def main(args):
     @param args: dictionary of command-line arguments.
     '''
 
-    d = DataFrame()
-    df = concat([BEDFileFactory(elem).build().get_data()
-                 for elem in parse_config(args['in'])])
-    ts, ub = df[df['Class'] == TISSUE_SPEC], df[df['Class'] == UBIQUITOUS]
-    combs = product(*[df['Tissue'].unique(),
-                                df['Length'].unique(), df['Length'].unique()])
-    for t, l_ts, l_ub in list(combs):  # iterate over tissue, lengths
-        x = list(chain.from_iterable(
-            list(ts[(ts['Length'] == l_ts) & (ts['Tissue'] == t)]['Vectors'])))
-        y = list(chain.from_iterable(
-            list(ub[(ub['Length'] == l_ub) & (ub['Tissue'] == t)]['Vectors'])))
-        d = d.append({'Tissue': t, 'PValue': wilcox_test(x, y),
-                      'Length_TS': l_ts, 'Length_UB': l_ub}, ignore_index=True)
-    d.to_csv(sys.stdout, index=False)
+    metrics.configure(args['metrics'], args['profile'])
+    cache = open_cache(args['cache'])
+    store = open_store(args['incremental'])
+    if store is not None:  # only changed tissues are contrasted
+        write_results(incremental_table(parse_config(args['in']), store,
+                                        args['jobs'], cache, args['summary'],
+                                        args['window']),
+                      args['out'], args['format'])
+        return
+    run(args, BEDFileFactory.build_all(parse_config(args['in']),
+                                       args['jobs'], cache))
+
+
+def run(args, beds, df=None):
+    '''
+    Sends the p-values contrasting all BED vectors to standard-output.
+    @param args: dictionary of command-line arguments.
+    @param beds: list of BEDFile objects; already built.
+    @param df: data-frame of all BED contents; combined from beds if None.
+    '''
+
+    df = BEDFileFactory.combine(beds) if df is None else df
+    write_results(similarity_table(df, args['jobs'], args['summary'],
+                                   args['window']),
+                  args['out'], args['format'])
+
+
+def arguments(parser):
+    '''
+    Adds the command-line arguments of this script.
+    @param parser: argparse.ArgumentParser object.
+    @return: the same parser.
+    '''
+
+    parser.add_argument('-in', metavar='XML', required=True,
+                        help='XML configuration file [req]')
+    parser.add_argument('-cache', metavar='DIR', default=None,
+                        help='Cache parsed BED files in folder [None]')
+    parser.add_argument('-jobs', metavar='INT', default=None, type=int,
+                        help='Workers for loading BEDs, rank-sums [#CPUs]')
+    parser.add_argument('-incremental', metavar='DIR', default=None,
+                        help='Re-use per-tissue results in folder [None]')
+    parser.add_argument('-summary', default=None, choices=SUMMARIES,
+                        help='Contrast a value per entry, not bases [None]')
+    parser.add_argument('-window', metavar='INT', default=10, type=int,
+                        help='Window length given -summary window [10]')
+    parser.add_argument('-out', metavar='FILE', default=None,
+                        help='Results filename [stdout]')
+    parser.add_argument('-format', default='csv', choices=FORMATS,
+                        help='Results format; all but csv need -out [csv]')
+    parser.add_argument('-metrics', metavar='FILE', default=None,
+                        help='Append per-stage metrics to FILE [None]')
+    parser.add_argument('-profile', metavar='DIR', default=None,
+                        help='Save per-stage cProfile dumps to DIR [None]')
+    return parser
+
 
 if __name__ == '__main__':
     try:
-        parser = argparse.ArgumentParser()
-        parser.add_argument('-in', metavar='XML', required=True,
-                            help='XML configuration file [req]')
-        args = vars(parser.parse_args())  # parse arguments
+        args = parse_arguments(arguments(argparse.ArgumentParser()))
         main(args)
     except OSError as e:
         print(e)